@@ -0,0 +1,240 @@
+#! /usr/bin/env python3
+
+######## Benchmarks for the ETL hot paths ########
+######## Database benchmarks need the usual REDSHIFT_* / DB_NAME variables, ########
+######## pointed at a scratch (local Postgres) database. `load` commits nothing; ########
+######## `e2e` empties the pipeline tables before every size. ########
+
+import os
+import sys
+import json
+import time
+import random
+import argparse
+import tempfile
+import contextlib
+import subprocess
+from datetime import datetime
+import psycopg2
+from fake_s3 import FakeS3
+from log_generator import generate_lines, generate_log, USER_AGENTS
+from log_parser import LogParser
+from parallel_parse import LocalSource, parse_source, PARSE_WORKERS
+import user_agent
+
+def report(name: str, rows: int, seconds: float) -> None:
+    print(f'{name:<24} {rows:>10} rows {seconds:>9.2f} s {rows / seconds:>12.0f} rows/s')
+
+def bench_load(args) -> None:
+    import s3_to_redshift
+
+    s3_to_redshift.create_table()
+    for layout in (18, 14):
+        lines = list(generate_lines(args.lines, layout=layout))
+        for name, loader in (('insert', s3_to_redshift.insert_logs),
+                             ('copy', s3_to_redshift.copy_logs)):
+            conn = psycopg2.connect(**s3_to_redshift.redshift_db_config)
+            try:
+                cursor = conn.cursor()
+                start = time.perf_counter()
+                # keep terminal I/O out of the row-by-row measurement
+                with open(os.devnull, 'w') as devnull, contextlib.redirect_stdout(devnull):
+                    loader(cursor, s3_to_redshift.parse_logs(lines), 0)
+                elapsed = time.perf_counter() - start
+            finally:
+                conn.rollback()
+                conn.close()
+            report(f'load {name} ({layout} fields)', args.lines, elapsed)
+
+def bench_parse(args) -> None:
+    # Half the lines in each layout, with a #Fields: change in the middle
+    lines = [*generate_lines(args.lines // 2, layout=18),
+             *generate_lines(args.lines - args.lines // 2, layout=14)]
+
+    start = time.perf_counter()
+    for line in lines:
+        line.split(' ')
+    report('parse split only', args.lines, time.perf_counter() - start)
+
+    for name, typed in (('parse raw', False), ('parse typed', True)):
+        start = time.perf_counter()
+        rows = sum(1 for _ in LogParser(typed=typed).parse(lines))
+        report(name, rows, time.perf_counter() - start)
+
+    # Same lines from a local file, in byte ranges across a process pool
+    path = os.path.join(tempfile.mkdtemp(), 'bench.log')
+    with open(path, 'w') as log_file:
+        log_file.write('\n'.join(lines) + '\n')
+    for name, typed in (('parse parallel raw', False), ('parse parallel typed', True)):
+        start = time.perf_counter()
+        rows = sum(len(batch) for batch in parse_source(LocalSource(path), args.workers,
+                                                        typed=typed))
+        report(f'{name} ({args.workers})', rows, time.perf_counter() - start)
+    os.remove(path)
+
+def bench_classify(args) -> None:
+    # args.lines user agents drawn from args.distinct variants of the
+    # generator's strings, a few of them far more common than the rest
+    rng       = random.Random(0)
+    variants  = [f'{rng.choice(USER_AGENTS)}+build/{i}' for i in range(args.distinct)]
+    weights   = [1 / (rank + 1) for rank in range(args.distinct)]
+    agents    = rng.choices(variants, weights, k=args.lines)
+    uncached  = (user_agent.is_crawler.__wrapped__, user_agent.parse_user_agent.__wrapped__)
+
+    start = time.perf_counter()
+    for agent in agents:
+        uncached[0](agent)
+    report('crawler uncached', args.lines, time.perf_counter() - start)
+
+    user_agent.is_crawler.cache_clear()
+    start = time.perf_counter()
+    for agent in agents:
+        user_agent.is_crawler(agent)
+    report('crawler memoized', args.lines, time.perf_counter() - start)
+
+    user_agent.is_crawler.cache_clear()
+    start = time.perf_counter()
+    for first in range(0, args.lines, args.batch):
+        user_agent.classify_many(agents[first:first + args.batch])
+    report(f'crawler batch ({args.batch})', args.lines, time.perf_counter() - start)
+
+    start = time.perf_counter()
+    for agent in agents:
+        uncached[1](agent)
+    report('parse uncached', args.lines, time.perf_counter() - start)
+
+    user_agent.parse_user_agent.cache_clear()
+    start = time.perf_counter()
+    for agent in agents:
+        user_agent.parse_user_agent(agent)
+    report('parse memoized', args.lines, time.perf_counter() - start)
+
+PIPELINE_TABLES = ('public.s3_load', 'public.s3_load_manifest', 'public.etl_1',
+                   'public.dim_date', 'public.dim_time', 'public.dim_location',
+                   'public.dim_request', 'public.dim_file', 'public.dim_visit',
+                   'public.dim_user_agent', 'public.dim_session', 'public.open_sessions',
+                   'public.rollup_hourly', 'public.rollup_daily', 'public.pipeline_state',
+                   'public.load_batch_claims')
+
+def write_geo_csv(path: str) -> None:
+    # One location per /16 of the generator's 81.0.0.0/8 client range, so
+    # dim_location is built offline instead of calling the lookup service
+    with open(path, 'w') as geo_csv:
+        geo_csv.write('network,postcode,city,region,country\n')
+        for i in range(256):
+            geo_csv.write(f'81.{i}.0.0/16,PC{i},City {i},Region {i % 16},GB\n')
+
+def git_revision() -> str:
+    try:
+        return subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], capture_output=True,
+                              text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+def bench_e2e(args) -> None:
+    geo_csv = os.path.join(tempfile.mkdtemp(), 'geo.csv')
+    write_geo_csv(geo_csv)
+    os.environ.setdefault('GEO_CSV', geo_csv)
+    import pipeline
+    import s3_to_redshift
+    import redshift_etl_1
+    import redshift_etl_2
+    import rollups
+    import sessionize
+    from redshift_connect import UseRedshift
+
+    workers = args.workers or pipeline.PIPELINE_WORKERS
+    config  = {name: os.environ.get(name) for name in
+               ('LOAD_MODE', 'ETL_1_MODE', 'KEY_MODE', 'LOAD_BATCH_SIZE', 'ETL_BATCH_SIZE')}
+    run     = {'run': datetime.utcnow().isoformat(timespec='seconds'),
+               'revision': git_revision(), 'config': config}
+    for size in args.sizes:
+        s3_to_redshift.create_table()
+        s3_to_redshift.create_manifest_table()
+        redshift_etl_1.create_table()
+        redshift_etl_2.create_table()
+        rollups.create_table()
+        sessionize.create_table()
+        with UseRedshift(s3_to_redshift.redshift_db_config) as cursor:
+            cursor.execute(f'TRUNCATE {", ".join(PIPELINE_TABLES)}')
+
+        # Half the objects in each layout, as in the real bucket
+        s3    = FakeS3()
+        lines = []
+        for i in range(args.objects):
+            count  = size // args.objects + (i < size % args.objects)
+            layout = 18 if i % 2 == 0 else 14
+            lines += generate_lines(count, layout=layout, seed=i, ips=args.ips,
+                                    cookies=args.cookies)
+            s3.put_object(Bucket=s3_to_redshift.log_bucket,
+                          Key=f'{s3_to_redshift.log_prefix}bench_{i:04}.log',
+                          Body=generate_log(count, layout, seed=i, ips=args.ips,
+                                            cookies=args.cookies))
+
+        state = {'completed': [], 'batches': None}
+
+        def build_dimensions():
+            # Concurrently, as pipeline.py runs them
+            pipeline.plan_etl_2(state)
+            pipeline.run_stages({name: ((), pipeline.STAGES[name][1])
+                                 for name in pipeline.DIMENSION_STAGES},
+                                state, workers, lambda state: None)
+
+        stages = (('parse', lambda: sum(1 for _ in LogParser().parse(lines))),
+                  ('load', lambda: s3_to_redshift.insert_into_bucket(s3_client=s3)),
+                  ('transform', redshift_etl_1.main),
+                  ('dimensions', build_dimensions),
+                  ('fact_keys', lambda: pipeline.run_fact_keys(state)),
+                  ('sessions', sessionize.main),
+                  ('rollups', rollups.main))
+        results = []
+        for name, run_stage in stages:
+            start = time.perf_counter()
+            with open(os.devnull, 'w') as devnull, contextlib.redirect_stdout(devnull):
+                run_stage()
+            elapsed = time.perf_counter() - start
+            report(f'e2e {name} ({size})', size, elapsed)
+            results.append({**run, 'size': size, 'stage': name, 'seconds': round(elapsed, 3),
+                            'rows_per_sec': round(size / elapsed, 1)})
+
+        # Appended, one JSON object per stage, so runs can be compared later
+        with open(args.output, 'a') as results_file:
+            for result in results:
+                results_file.write(json.dumps(result) + '\n')
+
+def main(argv=None) -> None:
+    parser = argparse.ArgumentParser(description='ETL benchmarks')
+    commands = parser.add_subparsers(dest='command', required=True)
+
+    load = commands.add_parser('load', help='row-by-row INSERT vs bulk COPY into s3_load')
+    load.add_argument('--lines', type=int, default=20000)
+    load.set_defaults(func=bench_load)
+
+    parse = commands.add_parser('parse', help='W3C log parser lines/sec')
+    parse.add_argument('--lines', type=int, default=2000000)
+    parse.add_argument('--workers', type=int, default=PARSE_WORKERS,
+                       help='processes for the parallel parse')
+    parse.set_defaults(func=bench_parse)
+
+    classify = commands.add_parser('classify', help='user-agent / crawler classifications/sec')
+    classify.add_argument('--lines', type=int, default=1000000)
+    classify.add_argument('--distinct', type=int, default=3000, help='distinct user agents')
+    classify.add_argument('--batch', type=int, default=10000, help='rows per classify_many')
+    classify.set_defaults(func=bench_classify)
+
+    e2e = commands.add_parser('e2e', help='every stage end to end on a FakeS3 bucket')
+    e2e.add_argument('--sizes', type=lambda sizes: [int(size) for size in sizes.split(',')],
+                     default=[10000, 100000], help='comma separated row counts')
+    e2e.add_argument('--objects', type=int, default=4, help='log files per size')
+    e2e.add_argument('--ips', type=int, default=5000, help='distinct client IPs')
+    e2e.add_argument('--cookies', type=int, default=10000, help='distinct session cookies')
+    e2e.add_argument('--workers', type=int,
+                     help="concurrent dimension builders (default: pipeline.py's)")
+    e2e.add_argument('--output', default='benchmark_results.jsonl')
+    e2e.set_defaults(func=bench_e2e)
+
+    args = parser.parse_args(argv)
+    args.func(args)
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
@@ -0,0 +1,117 @@
+#! /usr/bin/env python3
+
+import io
+import gzip
+import uuid
+from itertools import islice
+from psycopg2.extras import execute_values
+
+BATCH_SIZE = 100000
+
+# Tab-delimited text with \N for NULL and backslash escaping is understood by
+# both Redshift's COPY (with ESCAPE) and Postgres' COPY ... FROM STDIN
+_ESCAPES = str.maketrans({'\\': '\\\\', '\t': '\\\t', '\n': '\\\n', '\r': '\\\r'})
+
+def _encode_value(value) -> str:
+    if value is None:
+        return r'\N'
+    if value is True:
+        return 't'
+    if value is False:
+        return 'f'
+    return str(value).translate(_ESCAPES)
+
+def encode_batch(rows, compress: bool = True) -> bytes:
+    text = ''.join('\t'.join(_encode_value(value) for value in row) + '\n'
+                   for row in rows)
+    data = text.encode()
+    if compress:
+        return gzip.compress(data, compresslevel=6)
+    return data
+
+def copy_from_stdin(cursor, table: str, columns, data: bytes) -> None:
+    # Local Postgres stand-in: stream the (uncompressed) batch straight in
+    cursor.copy_expert(rf"""COPY {table} ({', '.join(columns)})
+                        FROM STDIN WITH (FORMAT text, NULL '\N')""",
+                        io.BytesIO(data))
+
+def copy_from_s3(cursor, s3_client, bucket: str, key: str, table: str,
+                 columns, data: bytes, iam_role: str) -> None:
+    # Redshift can't COPY from the client, so the batch is staged in S3
+    s3_client.put_object(Bucket=bucket, Key=key, Body=data)
+    try:
+        cursor.execute(rf"""COPY {table} ({', '.join(columns)})
+                            FROM 's3://{bucket}/{key}'
+                            IAM_ROLE '{iam_role}'
+                            DELIMITER '\t' NULL AS '\\N' ESCAPE GZIP""")
+    finally:
+        s3_client.delete_object(Bucket=bucket, Key=key)
+
+def iter_batches(rows, batch_size: int = BATCH_SIZE):
+    rows = iter(rows)
+    while True:
+        batch = list(islice(rows, batch_size))
+        if not batch:
+            return
+        yield batch
+
+def copy_rows(cursor, table: str, columns, rows, batch_size: int = BATCH_SIZE,
+              s3_client=None, bucket: str = None, prefix: str = 'staging/',
+              iam_role: str = None) -> int:
+    total = 0
+    for batch in iter_batches(rows, batch_size):
+        if iam_role:
+            key = f'{prefix}{table}/{uuid.uuid4()}.tsv.gz'
+            copy_from_s3(cursor, s3_client, bucket, key, table, columns,
+                         encode_batch(batch), iam_role)
+        else:
+            copy_from_stdin(cursor, table, columns,
+                            encode_batch(batch, compress=False))
+        total += len(batch)
+    return total
+
+def insert_values(cursor, table: str, columns, rows, page_size: int = 1000) -> int:
+    # Multi-row INSERT ... VALUES, page_size rows per round trip
+    rows = list(rows)
+    execute_values(cursor,
+                   rf"""INSERT INTO {table} ({', '.join(columns)}) VALUES %s""",
+                   rows, page_size=page_size)
+    return len(rows)
+
+def null_safe_equal(left: str, right: str, sentinel: str = "''") -> str:
+    # left = right, NULL matching NULL. `OR (left IS NULL AND right IS NULL)`
+    # leaves nothing to hash-join on, so every match becomes a nested loop;
+    # these are two plain equalities instead. sentinel is any literal of the
+    # column's type: the IS NULL comparison tells it apart from a real value
+    return (f'COALESCE({left}, {sentinel}) = COALESCE({right}, {sentinel}) '
+            f'AND ({left} IS NULL) = ({right} IS NULL)')
+
+def null_safe_equals(columns, left: str, right: str, sentinels: dict = None) -> str:
+    # Plain `=` never matches NULL to NULL, which duplicates dimension rows.
+    # sentinels: column -> literal of its type, for columns that aren't VARCHAR
+    sentinels = sentinels or {}
+    return ' AND '.join(null_safe_equal(f'{left}.{column}', f'{right}.{column}',
+                                        sentinels.get(column, "''"))
+                        for column in columns)
+
+def upsert_rows(cursor, table: str, columns, key_columns, rows,
+                page_size: int = 10000, sentinels: dict = None) -> int:
+    # Stage the candidate rows, keep one per natural key and insert only
+    # those whose key isn't in the table yet, all NULL-safe. The temp table
+    # is only dropped on success: after an error the transaction is aborted
+    # (a DROP would fail and hide the error) and the rollback removes it
+    stage = f'stage_{table.split(".")[-1]}'
+    cursor.execute(rf"""CREATE TEMP TABLE {stage} (LIKE {table})""")
+    insert_values(cursor, stage, columns, rows, page_size=page_size)
+    cursor.execute(rf"""INSERT INTO {table} ({', '.join(columns)})
+                        SELECT {', '.join(f'stage.{column}' for column in columns)}
+                        FROM (SELECT {stage}.*, ROW_NUMBER() OVER (
+                                PARTITION BY {', '.join(key_columns)} ORDER BY id) AS row_number
+                              FROM {stage}) stage
+                        WHERE stage.row_number = 1
+                            AND NOT EXISTS (SELECT 1 FROM {table} target
+                                            WHERE {null_safe_equals(key_columns, 'target', 'stage',
+                                                                    sentinels)})""")
+    inserted = cursor.rowcount
+    cursor.execute(rf"""DROP TABLE {stage}""")
+    return inserted
@@ -0,0 +1,15 @@
+#! /usr/bin/env python3
+
+from datetime import timedelta
+from dimensions import date_attributes, time_attributes
+
+SECONDS_PER_DAY = 86400
+
+def date_rows(start, end, new_id) -> list:
+    # Every public.dim_date row from start to end inclusive, all attributes filled
+    days = (start + timedelta(days=i) for i in range((end - start).days + 1))
+    return [(new_id(day), day, *date_attributes(day)) for day in days]
+
+def time_rows(new_id, seconds=range(SECONDS_PER_DAY)) -> list:
+    # public.dim_time rows, one per second of the day
+    return [(new_id(second), second, *time_attributes(second)) for second in seconds]
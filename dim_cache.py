@@ -0,0 +1,113 @@
+#! /usr/bin/env python3
+
+from collections import OrderedDict
+from bulk_load import insert_values
+from dimensions import DIMENSION_KEYS, DIMENSION_COLUMNS, dimension_row
+
+CACHE_SIZE = 1000000 # members kept per dimension before LRU eviction
+
+class DimensionCache:
+
+    # natural key -> id for one public.dim_* table. New members get ids
+    # locally and are written in bulk by flush(); members evicted from the
+    # LRU are looked up in the table again if they come back.
+    # locate(client_ips) -> {ip: location} fills in new dim_location
+    # members; an IP whose lookup failed gets no member and a None id, so it
+    # is looked up again the next time it comes
+
+    def __init__(self, dimension: str, new_id, max_size: int = CACHE_SIZE,
+                 locate=None) -> None:
+        self.dimension = dimension
+        self.table     = f'public.dim_{dimension}'
+        self.columns   = DIMENSION_KEYS[dimension]
+        self.new_id    = new_id
+        self.max_size  = max_size
+        self.locate    = locate if dimension == 'location' else None
+        self.ids       = OrderedDict()
+        self.pending   = []
+        self.complete  = True # every known member is in memory
+        self.counters  = {'hits': 0, 'misses': 0, 'fetched': 0,
+                          'assigned': 0, 'evicted': 0, 'unlocated': 0}
+
+    def _remember(self, key: tuple, dim_id: str) -> None:
+        self.ids[key] = dim_id
+        self.ids.move_to_end(key)
+        if len(self.ids) > self.max_size:
+            self.ids.popitem(last=False)
+            self.counters['evicted'] += 1
+            self.complete = False
+
+    def load(self, cursor) -> None:
+        source = cursor.connection.cursor(name=f'load_dim_{self.dimension}')
+        source.itersize = 50000
+        source.execute(rf"""SELECT {', '.join(self.columns)}, id FROM {self.table}""")
+        for row in source:
+            self._remember(tuple(row[:-1]), row[-1])
+        source.close()
+
+    def _fetch(self, cursor, keys) -> None:
+        # NULL-safe lookup of members that were evicted from memory
+        matches = ' AND '.join(f'({column} = %s OR ({column} IS NULL AND %s IS NULL))'
+                               for column in self.columns)
+        for i in range(0, len(keys), 500):
+            chunk  = keys[i:i + 500]
+            params = [value for key in chunk for value in key for _ in (0, 1)]
+            cursor.execute(rf"""SELECT {', '.join(self.columns)}, id FROM {self.table}
+                                WHERE {' OR '.join(f'({matches})' for _ in chunk)}""",
+                           params)
+            for row in cursor.fetchall():
+                self._remember(tuple(row[:-1]), row[-1])
+                self.counters['fetched'] += 1
+
+    def resolve_many(self, cursor, keys) -> list:
+        keys    = list(keys)
+        missing = list({key for key in keys if key not in self.ids})
+        self.counters['hits']   += len(keys) - len(missing)
+        self.counters['misses'] += len(missing)
+        if missing and not self.complete:
+            self._fetch(cursor, missing)
+        new_keys  = [key for key in missing if key not in self.ids]
+        locations = self._locate(new_keys)
+        unlocated = set()
+        for key in new_keys:
+            if locations is not None and key[0] is not None and key[0] not in locations:
+                unlocated.add(key)
+                self.counters['unlocated'] += 1
+                continue
+            dim_id = self.new_id(*key)
+            self.pending.append((dim_id, key, (locations or {}).get(key[0])))
+            self.counters['assigned'] += 1
+            self._remember(key, dim_id)
+        ids = self.ids
+        for key in set(keys): # refresh LRU order for this batch
+            if key in ids:
+                ids.move_to_end(key)
+        return [ids[key] if key in ids else
+                None if key in unlocated else self._lookup_again(cursor, key)
+                for key in keys]
+
+    def _locate(self, keys) -> dict:
+        # None when this dimension has no locate()
+        if self.locate is None:
+            return None
+        client_ips = [key[0] for key in keys if key[0] is not None]
+        return self.locate(client_ips) if client_ips else {}
+
+    def _lookup_again(self, cursor, key: tuple) -> str:
+        # Only reached if this batch alone has more distinct keys than max_size
+        for dim_id, pending_key, _ in self.pending:
+            if pending_key == key:
+                return dim_id
+        self._fetch(cursor, [key])
+        return self.ids[key]
+
+    def flush(self, cursor) -> int:
+        if not self.pending:
+            return 0
+        rows = [dimension_row(self.dimension, dim_id, key, location)
+                for dim_id, key, location in self.pending]
+        self.pending = []
+        return insert_values(cursor, self.table, DIMENSION_COLUMNS[self.dimension], rows)
+
+    def stats(self) -> dict:
+        return {**self.counters, 'size': len(self.ids)}
@@ -0,0 +1,159 @@
+#! /usr/bin/env python3
+
+import re
+import hashlib
+from bisect import bisect_right
+from log_parser import LOG_COLUMNS, INT_COLUMNS
+from bulk_load import null_safe_equal
+from user_agent import parse_user_agent, is_crawler
+
+# Natural key columns of each public.dim_* table and the etl_1 column
+# that holds its id. Keys are etl_1 columns, except the ones derived from
+# an etl_1 column (see DERIVED_KEYS / KEY_SQL): dim_time is keyed by second
+# of the day and dim_request by duration bucket, so neither grows with traffic.
+# The raw duration stays on etl_1 as a measure
+DIMENSION_KEYS = {'date':       ('date',),
+                  'time':       ('second_of_day',),
+                  'location':   ('client_ip',),
+                  'request':    ('method', 'client_referrer', 'status', 'duration_bucket'),
+                  'file':       ('uri_stem', 'bytes_sent'),
+                  'visit':      ('client_cookie',),
+                  'user_agent': ('client_browser',)}
+FACT_KEY_COLUMNS = {'date':       'date_id',
+                    'time':       'time_id',
+                    'location':   'location_id',
+                    'request':    'request_id',
+                    'file':       'file_id',
+                    'visit':      'visit_id',
+                    'user_agent': 'user_agent_id'}
+
+# Columns of each public.dim_* table, as written by dimension_row
+DIMENSION_COLUMNS = {'date':       ('id', 'date', 'day', 'week', 'month', 'quarter',
+                                    'year'),
+                     'time':       ('id', 'second_of_day', 'hour', 'minute', 'second'),
+                     'location':   ('id', 'client_ip', 'postcode', 'city', 'region',
+                                    'country'),
+                     'request':    ('id', 'method', 'client_referrer', 'status',
+                                    'duration_bucket'),
+                     'file':       ('id', 'uri_stem', 'bytes_sent', 'file_type',
+                                    'is_crawler'),
+                     'visit':      ('id', 'client_cookie'),
+                     'user_agent': ('id', 'client_browser', 'browser', 'os', 'device_type',
+                                    'is_crawler')}
+
+# Upper bounds (ms, exclusive) and labels of the request duration buckets
+DURATION_BUCKETS = ((100, '0-99ms'), (250, '100-249ms'), (500, '250-499ms'),
+                    (1000, '500-999ms'), (2500, '1-2.5s'), (5000, '2.5-5s'),
+                    (10000, '5-10s'), (30000, '10-30s'), (None, '30s+'))
+_DURATION_BOUNDS = [bound for bound, _ in DURATION_BUCKETS[:-1]]
+
+def second_of_day(time) -> int:
+    if time is None:
+        return None
+    return time.hour * 3600 + time.minute * 60 + time.second
+
+def duration_bucket(duration):
+    if duration is None:
+        return None
+    return DURATION_BUCKETS[bisect_right(_DURATION_BOUNDS, duration)][1]
+
+# Key columns derived from an etl_1 column: (etl_1 column, conversion)
+DERIVED_KEYS = {'second_of_day':   ('time', second_of_day),
+                'duration_bucket': ('duration', duration_bucket)}
+
+# The same derivations in SQL ({alias} is the etl_1 row)
+KEY_SQL = {'second_of_day': """CAST(DATE_PART('hour', {alias}.time) * 3600
+                                + DATE_PART('minute', {alias}.time) * 60
+                                + FLOOR(DATE_PART('second', {alias}.time)) AS INT)""",
+           'duration_bucket': 'CASE WHEN {alias}.duration IS NULL THEN NULL '
+                              + ' '.join(f"WHEN {{alias}}.duration < {bound} THEN '{label}'"
+                                         for bound, label in DURATION_BUCKETS[:-1])
+                              + f" ELSE '{DURATION_BUCKETS[-1][1]}' END"}
+
+# A literal of each key column's type that isn't VARCHAR, for null_safe_equal
+KEY_SENTINELS = {'date':          "CAST('1900-01-01' AS DATE)",
+                 'second_of_day': '0',
+                 **{column: '0' for column in INT_COLUMNS}}
+
+_KEY_POSITIONS   = {dimension: tuple(LOG_COLUMNS.index(DERIVED_KEYS[column][0]
+                                                       if column in DERIVED_KEYS else column)
+                                     for column in columns)
+                    for dimension, columns in DIMENSION_KEYS.items()}
+_KEY_CONVERSIONS = {dimension: tuple(DERIVED_KEYS[column][1] if column in DERIVED_KEYS else None
+                                     for column in columns)
+                    for dimension, columns in DIMENSION_KEYS.items()}
+
+def key_sql(column: str, alias: str) -> str:
+    if column in KEY_SQL:
+        return KEY_SQL[column].format(alias=alias)
+    return f'{alias}.{column}'
+
+# Each value is length-prefixed and NULL has its own marker, so e.g.
+# (NULL, 'a') and ('', 'a') or ('a|b',) and ('a', 'b') never collide.
+# dimension_key_sql builds the identical string (and hash) in SQL.
+def _key_part(value) -> str:
+    if value is None:
+        return 'n'
+    text = str(value)
+    return f'v{len(text)}:{text}'
+
+def dimension_key(*values) -> str:
+    return hashlib.md5(''.join(map(_key_part, values)).encode()).hexdigest()
+
+def dimension_match_sql(dimension: str, alias: str, dim_alias: str) -> str:
+    # NULL-safe join of etl_1 row {alias} to its public.dim_* row {dim_alias}
+    return ' AND '.join(null_safe_equal(key_sql(column, alias), f'{dim_alias}.{column}',
+                                        KEY_SENTINELS.get(column, "''"))
+                        for column in DIMENSION_KEYS[dimension])
+
+def dimension_key_sql(dimension: str, alias: str) -> str:
+    # Hash of a dimension's natural key computed from etl_1 row {alias}
+    parts = (rf"""COALESCE('v' || LENGTH(CAST({key_sql(column, alias)} AS VARCHAR)) || ':'
+                    || CAST({key_sql(column, alias)} AS VARCHAR), 'n')"""
+             for column in DIMENSION_KEYS[dimension])
+    return 'MD5(' + ' || '.join(parts) + ')'
+
+def natural_keys(row) -> tuple:
+    # Natural key tuples of a typed etl_1 record (LOG_COLUMNS order, see
+    # to_etl_1_row), in FACT_KEY_COLUMNS order
+    return tuple(tuple(row[i] if convert is None else convert(row[i])
+                       for i, convert in zip(positions, _KEY_CONVERSIONS[dimension]))
+                 for dimension, positions in _KEY_POSITIONS.items())
+
+def fact_keys(row) -> tuple:
+    # Hashed natural keys of a typed etl_1 record, in FACT_KEY_COLUMNS order
+    return tuple(dimension_key(*key) for key in natural_keys(row))
+
+def date_attributes(date) -> tuple:
+    # day, week (ISO), month, quarter, year
+    return (date.day, date.isocalendar()[1], date.month, (date.month - 1) // 3 + 1,
+            date.year)
+
+def time_attributes(second_of_day: int) -> tuple:
+    # hour, minute, second
+    return second_of_day // 3600, second_of_day // 60 % 60, second_of_day % 60
+
+def file_attributes(uri_stem) -> tuple:
+    # file_type, is_crawler
+    file_ext = re.search(r'\.[A-Za-z0-9]+$', uri_stem or '')
+    if file_ext is not None:
+        file_type = file_ext.group(0)
+    else:
+        file_type = None
+    return file_type, uri_stem == '/robots.txt'
+
+def dimension_row(dimension: str, dim_id: str, key: tuple, location: dict = None) -> tuple:
+    # Full public.dim_* row (DIMENSION_COLUMNS order) for a natural key
+    if dimension == 'date':
+        return (dim_id, *key, *date_attributes(key[0]))
+    if dimension == 'time':
+        return (dim_id, *key, *time_attributes(key[0]))
+    if dimension == 'location':
+        location = location or {}
+        return (dim_id, *key, location.get('postcode'), location.get('city'),
+                location.get('region'), location.get('country'))
+    if dimension == 'file':
+        return (dim_id, *key, *file_attributes(key[0]))
+    if dimension == 'user_agent':
+        return (dim_id, *key, *parse_user_agent(key[0]), is_crawler(key[0]))
+    return (dim_id, *key)
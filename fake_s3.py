@@ -0,0 +1,63 @@
+#! /usr/bin/env python3
+
+import io
+import hashlib
+import threading
+
+class _Paginator:
+
+    def __init__(self, s3, page_size: int) -> None:
+        self.s3        = s3
+        self.page_size = page_size
+
+    def paginate(self, Bucket: str, Prefix: str = ''):
+        keys = sorted(key for key in self.s3.objects.get(Bucket, {}) if key.startswith(Prefix))
+        for i in range(0, len(keys), self.page_size):
+            yield {'Contents': [{'Key': key, 'ETag': self.s3.etag(Bucket, key),
+                                 'Size': len(self.s3.objects[Bucket][key])}
+                                for key in keys[i:i + self.page_size]]}
+
+class FakeS3:
+
+    # In-process stand-in for the parts of the boto3 S3 client the pipeline
+    # uses (get_object with Range, head_object, put_object, delete_object,
+    # list_objects_v2 pages), so benchmarks measure the pipeline rather than
+    # the network
+
+    def __init__(self, page_size: int = 1000) -> None:
+        self.objects   = {} # bucket -> key -> bytes
+        self.page_size = page_size
+        self.lock      = threading.Lock()
+
+    def etag(self, bucket: str, key: str) -> str:
+        return '"' + hashlib.md5(self.objects[bucket][key]).hexdigest() + '"'
+
+    def put_object(self, Bucket: str, Key: str, Body) -> dict:
+        data = Body.read() if hasattr(Body, 'read') else Body
+        if isinstance(data, str):
+            data = data.encode()
+        with self.lock:
+            self.objects.setdefault(Bucket, {})[Key] = data
+        return {'ETag': self.etag(Bucket, Key)}
+
+    def get_object(self, Bucket: str, Key: str, Range: str = None) -> dict:
+        data = self.objects[Bucket][Key]
+        if Range is not None: # 'bytes=first-last', both inclusive
+            first, last = Range[len('bytes='):].split('-')
+            data = data[int(first):int(last) + 1 if last else None]
+        return {'Body': io.BytesIO(data), 'ContentLength': len(data),
+                'ETag': self.etag(Bucket, Key)}
+
+    def head_object(self, Bucket: str, Key: str) -> dict:
+        return {'ContentLength': len(self.objects[Bucket][Key]),
+                'ETag': self.etag(Bucket, Key)}
+
+    def delete_object(self, Bucket: str, Key: str) -> dict:
+        with self.lock:
+            self.objects.get(Bucket, {}).pop(Key, None)
+        return {}
+
+    def get_paginator(self, operation: str) -> _Paginator:
+        if operation != 'list_objects_v2':
+            raise NotImplementedError(operation)
+        return _Paginator(self, self.page_size)
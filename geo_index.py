@@ -0,0 +1,177 @@
+#! /usr/bin/env python3
+
+import os
+import csv
+import json
+import mmap
+import struct
+import ipaddress
+from array import array
+from heapq import heappush, heappop
+from bisect import bisect_right
+
+# Serialised layout: MAGIC, header length, JSON header (padded to 16 bytes),
+# then the IPv4 start/end/location arrays (native uint32) and the IPv6
+# start/end blocks (16-byte big-endian) with their uint32 location array
+MAGIC           = b'GEOIDX1\n'
+LOCATION_FIELDS = ('postcode', 'city', 'region', 'country')
+
+class _Int128Array:
+
+    # Read-only sequence over packed 16-byte big-endian integers, enough
+    # for bisect to search IPv6 ranges without unpacking them all
+
+    def __init__(self, buffer) -> None:
+        self.buffer = buffer
+
+    def __len__(self) -> int:
+        return len(self.buffer) // 16
+
+    def __getitem__(self, i: int) -> int:
+        return int.from_bytes(self.buffer[i * 16:(i + 1) * 16], 'big')
+
+def _pack128(values) -> bytes:
+    return b''.join(value.to_bytes(16, 'big') for value in values)
+
+def _pad(length: int) -> bytes:
+    return b'\0' * (-length % 16)
+
+def _flatten(intervals) -> list:
+    # (first, last, location id) in input order -> disjoint intervals sorted
+    # by first, so one bisect finds an address. Where ranges overlap (e.g. a
+    # /24 inside a /8) the narrowest one wins; of equal ones the later row
+    pending = sorted(((first, last, -order, location_id)
+                      for order, (first, last, location_id) in enumerate(intervals)),
+                     reverse=True)
+    bounds  = sorted({bound for first, last, _, _ in pending for bound in (first, last + 1)})
+    active  = [] # (width, -order, last, location id) of ranges begun so far
+    flat    = []
+    for start, next_start in zip(bounds, bounds[1:]):
+        while pending and pending[-1][0] <= start:
+            first, last, order, location_id = pending.pop()
+            heappush(active, (last - first, order, last, location_id))
+        while active and active[0][2] < start:
+            heappop(active)
+        if not active:
+            continue
+        location_id = active[0][3]
+        if flat and flat[-1][1] == start - 1 and flat[-1][2] == location_id:
+            flat[-1] = (flat[-1][0], next_start - 1, location_id)
+        else:
+            flat.append((start, next_start - 1, location_id))
+    return flat
+
+class GeoIndex:
+
+    def __init__(self, v4, v6, locations) -> None:
+        # v4 / v6 are (starts, ends, location ids) sorted by start
+        self.v4        = v4
+        self.v6        = v6
+        self.locations = locations
+        self.buffer    = None
+
+    @classmethod
+    def from_ranges(cls, ranges) -> 'GeoIndex':
+        # ranges: (first ip, last ip, (postcode, city, region, country))
+        location_ids = {}
+        intervals    = {4: [], 6: []}
+        for first, last, location in ranges:
+            first, last = ipaddress.ip_address(first), ipaddress.ip_address(last)
+            location_id = location_ids.setdefault(tuple(location), len(location_ids))
+            if first.version != last.version or last < first:
+                raise ValueError(f'invalid geo range {first} - {last}')
+            intervals[first.version].append((int(first), int(last), location_id))
+        for version in intervals:
+            intervals[version] = _flatten(intervals[version])
+
+        v4 = tuple(array('I', column) for column in zip(*intervals[4])) or \
+             (array('I'), array('I'), array('I'))
+        v6 = (_Int128Array(_pack128(start for start, _, _ in intervals[6])),
+              _Int128Array(_pack128(end for _, end, _ in intervals[6])),
+              array('I', (location_id for _, _, location_id in intervals[6])))
+        return cls(v4, v6, list(location_ids))
+
+    @classmethod
+    def from_csv(cls, path: str) -> 'GeoIndex':
+        # Columns: either `network` (CIDR) or `start_ip` and `end_ip`,
+        # followed by postcode, city, region, country
+        def ranges():
+            with open(path, newline='') as csv_file:
+                for row in csv.DictReader(csv_file):
+                    location = tuple(row.get(field) or None for field in LOCATION_FIELDS)
+                    if row.get('network'):
+                        network = ipaddress.ip_network(row['network'], strict=False)
+                        yield network[0], network[-1], location
+                    else:
+                        yield row['start_ip'], row['end_ip'], location
+        return cls.from_ranges(ranges())
+
+    def save(self, path: str) -> None:
+        header = json.dumps({'v4': len(self.v4[0]), 'v6': len(self.v6[0]),
+                             'locations': self.locations}).encode()
+        header += _pad(len(MAGIC) + 8 + len(header))
+        with open(path, 'wb') as index_file:
+            index_file.write(MAGIC + struct.pack('<Q', len(header)) + header)
+            for column in self.v4:
+                index_file.write(column.tobytes() + _pad(len(column) * 4))
+            index_file.write(bytes(self.v6[0].buffer))
+            index_file.write(bytes(self.v6[1].buffer))
+            index_file.write(self.v6[2].tobytes())
+
+    @classmethod
+    def load(cls, path: str) -> 'GeoIndex':
+        # Arrays are memory-mapped, not parsed: startup cost is the header only
+        with open(path, 'rb') as index_file:
+            buffer = mmap.mmap(index_file.fileno(), 0, access=mmap.ACCESS_READ)
+        if buffer[:len(MAGIC)] != MAGIC:
+            raise ValueError(f'{path} is not a geo index file')
+        header_length, = struct.unpack_from('<Q', buffer, len(MAGIC))
+        offset = len(MAGIC) + 8
+        header = json.loads(bytes(buffer[offset:offset + header_length]).rstrip(b'\0'))
+        offset += header_length
+        view   = memoryview(buffer)
+
+        def take(length):
+            nonlocal offset
+            block   = view[offset:offset + length]
+            offset += length + len(_pad(length))
+            return block
+
+        v4 = tuple(take(header['v4'] * 4).cast('I') for _ in range(3))
+        v6 = (_Int128Array(take(header['v6'] * 16)),
+              _Int128Array(take(header['v6'] * 16)),
+              take(header['v6'] * 4).cast('I'))
+        index = cls(v4, v6, [tuple(location) for location in header['locations']])
+        index.buffer = buffer
+        return index
+
+    def lookup(self, ip: str):
+        try:
+            address = ipaddress.ip_address(ip)
+        except ValueError:
+            return None
+        starts, ends, location_ids = self.v4 if address.version == 4 else self.v6
+        value = int(address)
+        i = bisect_right(starts, value) - 1
+        if i < 0 or value > ends[i]:
+            return None
+        return dict(zip(LOCATION_FIELDS, self.locations[location_ids[i]]))
+
+    def lookup_many(self, ips) -> dict:
+        locations = {}
+        for ip in set(ips):
+            location = self.lookup(ip)
+            if location is not None:
+                locations[ip] = location
+        return locations
+
+def open_index(index_path: str = None, csv_path: str = None):
+    # Prefer the serialised index; build (and save) it from the CSV otherwise
+    if index_path and os.path.exists(index_path):
+        return GeoIndex.load(index_path)
+    if csv_path:
+        index = GeoIndex.from_csv(csv_path)
+        if index_path:
+            index.save(index_path)
+        return index
+    return None
@@ -0,0 +1,164 @@
+#! /usr/bin/env python3
+
+import time
+import json
+import atexit
+import sqlite3
+import threading
+import requests
+from concurrent.futures import ThreadPoolExecutor
+from geo_index import open_index
+
+CACHE_TTL = 30 * 24 * 3600 # seconds before a cached location is looked up again
+
+class GeoCache:
+
+    def __init__(self, path: str = 'geo_cache.sqlite', ttl: float = CACHE_TTL) -> None:
+        self.ttl  = ttl
+        self.lock = threading.Lock()
+        self.conn = sqlite3.connect(path, check_same_thread=False)
+        self.conn.execute("""CREATE TABLE IF NOT EXISTS geo_cache (
+                            ip TEXT PRIMARY KEY,
+                            location TEXT,
+                            fetched_at REAL)""")
+        self.conn.commit()
+
+    def get_many(self, ips) -> dict:
+        ips     = list(ips)
+        cutoff  = time.time() - self.ttl
+        found   = {}
+        with self.lock:
+            for i in range(0, len(ips), 500): # stay under SQLite's variable limit
+                chunk = ips[i:i + 500]
+                rows  = self.conn.execute(
+                    f"""SELECT ip, location FROM geo_cache
+                        WHERE fetched_at > ? AND ip IN ({', '.join('?' * len(chunk))})""",
+                    (cutoff, *chunk))
+                found.update((ip, json.loads(location)) for ip, location in rows)
+        return found
+
+    def put_many(self, locations: dict) -> None:
+        now = time.time()
+        with self.lock:
+            self.conn.executemany("""INSERT OR REPLACE INTO geo_cache(ip, location, fetched_at)
+                                    VALUES (?, ?, ?)""",
+                                  [(ip, json.dumps(location), now)
+                                   for ip, location in locations.items()])
+            self.conn.commit()
+
+    def evict(self) -> int:
+        with self.lock:
+            deleted = self.conn.execute("""DELETE FROM geo_cache WHERE fetched_at <= ?""",
+                                        (time.time() - self.ttl,)).rowcount
+            self.conn.commit()
+        return deleted
+
+    def close(self) -> None:
+        with self.lock:
+            self.conn.close()
+
+class IpInfoBackend:
+
+    # Any service answering GET {base_url}/{ip} with ipinfo.io-style JSON
+    # works here, e.g. a local stub server in tests
+
+    def __init__(self, base_url: str = 'https://ipinfo.io', token: str = None,
+                 timeout: float = 5.0) -> None:
+        self.base_url = base_url.rstrip('/')
+        self.token    = token
+        self.timeout  = timeout
+        self.sessions = threading.local()
+
+    def lookup(self, ip: str) -> dict:
+        session = getattr(self.sessions, 'session', None)
+        if session is None:
+            session = self.sessions.session = requests.Session()
+        params  = {'token': self.token} if self.token else None
+        results = session.get(f'{self.base_url}/{ip}', params=params, timeout=self.timeout)
+        results.raise_for_status()
+        results_dict = results.json()
+        return {'postcode': results_dict.get('postal'),
+                'city':     results_dict.get('city'),
+                'region':   results_dict.get('region'),
+                'country':  results_dict.get('country')}
+
+class RateLimiter:
+
+    def __init__(self, rate: float) -> None:
+        self.interval = 1.0 / rate if rate else 0.0
+        self.next_at  = time.monotonic()
+        self.lock     = threading.Lock()
+
+    def wait(self) -> None:
+        with self.lock:
+            now          = time.monotonic()
+            wait_until   = max(self.next_at, now)
+            self.next_at = wait_until + self.interval
+        if wait_until > now:
+            time.sleep(wait_until - now)
+
+def _retryable(err: Exception) -> bool:
+    response = getattr(err, 'response', None)
+    if response is None: # timeouts and connection errors
+        return True
+    return response.status_code == 429 or response.status_code >= 500
+
+def fetch_locations(ips, backend, workers: int = 8, rate: float = 10.0,
+                    retries: int = 3, backoff: float = 1.0) -> dict:
+    limiter = RateLimiter(rate)
+
+    def fetch(ip):
+        for attempt in range(retries + 1):
+            limiter.wait()
+            try:
+                return ip, backend.lookup(ip)
+            except requests.RequestException as err:
+                if attempt == retries or not _retryable(err):
+                    print(f'Error looking up {ip}: ', err)
+                    return ip, None
+                time.sleep(backoff * 2 ** attempt)
+
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        return {ip: location for ip, location in pool.map(fetch, ips)
+                if location is not None}
+
+def resolve_locations(ips, cache: GeoCache, backend, **fetch_options) -> dict:
+    # Cached IPs cost no network calls; only the rest are fetched (and cached)
+    ips     = set(ips)
+    found   = cache.get_many(ips)
+    fetched = fetch_locations([ip for ip in ips if ip not in found], backend,
+                              **fetch_options)
+    cache.put_many(fetched)
+    return {**found, **fetched}
+
+_resolvers      = {}
+_caches         = []
+_resolvers_lock = threading.Lock()
+
+def shared_resolver(index_path: str = None, csv_path: str = None,
+                    cache_path: str = 'geo_cache.sqlite', base_url: str = 'https://ipinfo.io',
+                    token: str = None, **fetch_options):
+    # resolve(ips) -> {ip: location} from the offline index if there is one,
+    # the cache and lookup service otherwise. Opened once per process for
+    # each set of arguments and shared by every batch and thread
+    key = (index_path, csv_path, cache_path, base_url, token,
+           tuple(sorted(fetch_options.items())))
+    with _resolvers_lock:
+        if key not in _resolvers:
+            index = open_index(index_path, csv_path)
+            if index is not None:
+                _resolvers[key] = index.lookup_many
+            else:
+                cache   = GeoCache(cache_path)
+                cache.evict() # once per process, so the file doesn't keep every IP ever seen
+                backend = IpInfoBackend(base_url, token)
+                _caches.append(cache)
+                _resolvers[key] = lambda ips: resolve_locations(ips, cache, backend,
+                                                                **fetch_options)
+        return _resolvers[key]
+
+@atexit.register
+def close_caches() -> None:
+    with _resolvers_lock:
+        for cache in _caches:
+            cache.close()
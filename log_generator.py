@@ -0,0 +1,58 @@
+#! /usr/bin/env python3
+
+import random
+from datetime import datetime, timedelta
+
+FIELDS_18 = ('date time s-ip cs-method cs-uri-stem cs-uri-query s-port '
+             'cs-username c-ip cs(User-Agent) cs(Cookie) cs(Referer) '
+             'sc-status sc-substatus sc-win32-status sc-bytes cs-bytes '
+             'time-taken')
+FIELDS_14 = ('date time s-ip cs-method cs-uri-stem cs-uri-query s-port '
+             'cs-username c-ip cs(User-Agent) sc-status sc-substatus '
+             'sc-win32-status time-taken')
+
+URI_STEMS  = ['/', '/index.html', '/robots.txt', '/favicon.ico',
+              '/css/site.css', '/js/app.js', '/images/logo.png',
+              '/tickets/search.aspx', '/tickets/buy.aspx', '/about.html']
+USER_AGENTS = ['Mozilla/5.0+(Windows+NT+6.1;+WOW64)+AppleWebKit/535.1',
+               'Mozilla/4.0+(compatible;+MSIE+8.0;+Windows+NT+5.1)',
+               'Mozilla/5.0+(compatible;+Googlebot/2.1;++http://www.google.com/bot.html)',
+               'Mozilla/5.0+(iPhone;+CPU+iPhone+OS+5_0+like+Mac+OS+X)',
+               'msnbot/2.0b+(+http://search.msn.com/msnbot.htm)']
+REFERRERS  = ['-', 'http://www.google.co.uk/search?q=tickets',
+              'http://www.example.com/', 'http://www.bing.com/']
+STATUSES   = [200, 200, 200, 200, 304, 304, 404, 500]
+
+def client_ip(i: int) -> str:
+    # i-th address of the synthetic client pool (81.0.0.0/8)
+    return f'81.{i >> 16 & 255}.{i >> 8 & 255}.{i & 255}'
+
+def generate_lines(count: int, layout: int = 18, seed: int = 0,
+                   start: datetime = datetime(2011, 4, 7), ips: int = None,
+                   cookies: int = 10000):
+    # ips / cookies: number of distinct client IPs and session cookies to
+    # draw from (ips=None draws from the whole 81.0.0.0/8 range)
+    rng = random.Random(seed)
+    if layout == 18:
+        yield '#Fields: ' + FIELDS_18
+    else:
+        yield '#Fields: ' + FIELDS_14
+    for i in range(count):
+        stamp  = start + timedelta(seconds=i * 86400 // max(count, 1))
+        fields = [stamp.strftime('%Y-%m-%d'), stamp.strftime('%H:%M:%S'),
+                  '10.0.0.1', rng.choice(['GET', 'GET', 'GET', 'POST']),
+                  rng.choice(URI_STEMS), '-', '80', '-',
+                  client_ip(rng.randrange(ips or 1 << 24)),
+                  rng.choice(USER_AGENTS)]
+        if layout == 18:
+            fields += [rng.choice(['-', f'ASP.NET_SessionId={rng.randrange(cookies)}']),
+                       rng.choice(REFERRERS)]
+        fields += [str(rng.choice(STATUSES)), '0', '0']
+        if layout == 18:
+            fields += [str(rng.randrange(200, 60000)), str(rng.randrange(200, 900))]
+        fields.append(str(rng.randrange(0, 2000)))
+        yield ' '.join(fields)
+
+def generate_log(count: int, layout: int = 18, **options) -> bytes:
+    # One log file's contents, as it would be stored in S3
+    return ('\r\n'.join(generate_lines(count, layout, **options)) + '\r\n').encode()
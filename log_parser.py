@@ -0,0 +1,105 @@
+#! /usr/bin/env python3
+
+from datetime import date, datetime
+from operator import itemgetter
+
+# W3C extended log field names -> s3_load column names
+FIELD_COLUMNS = {'date': 'date',
+                 'time': 'time',
+                 's-ip': 'server_ip',
+                 'cs-method': 'method',
+                 'cs-uri-stem': 'uri_stem',
+                 'cs-uri-query': 'uri_query',
+                 's-port': 'server_port',
+                 'cs-username': 'username',
+                 'c-ip': 'client_ip',
+                 'cs(User-Agent)': 'client_browser',
+                 'cs(Cookie)': 'client_cookie',
+                 'cs(Referer)': 'client_referrer',
+                 'sc-status': 'status',
+                 'sc-substatus': 'substatus',
+                 'sc-win32-status': 'win32_status',
+                 'sc-bytes': 'bytes_sent',
+                 'cs-bytes': 'bytes_received',
+                 'time-taken': 'duration'}
+
+# Parsed records are tuples in s3_load column order
+LOG_COLUMNS    = tuple(FIELD_COLUMNS.values())
+LOG_COLUMNS_14 = ('date', 'time', 'server_ip', 'method', 'uri_stem',
+                  'uri_query', 'server_port', 'username', 'client_ip',
+                  'client_browser', 'status', 'substatus', 'win32_status',
+                  'duration')
+INT_COLUMNS    = ('server_port', 'status', 'substatus', 'win32_status',
+                  'bytes_sent', 'bytes_received', 'duration')
+
+# Layouts assumed for files that don't start with a #Fields: directive
+DEFAULT_LAYOUTS = {18: LOG_COLUMNS, 14: LOG_COLUMNS_14}
+
+_INT_POSITIONS = tuple(LOG_COLUMNS.index(column) for column in INT_COLUMNS)
+
+def _to_int(value):
+    if value is None or value == '-':
+        return None
+    return int(value)
+
+def to_etl_1_row(record):
+    # s3_load record (strings) -> typed etl_1 values: date, timestamp,
+    # INT columns cast and a missing client_cookie turned into ''
+    row = list(record[:18])
+    for i in _INT_POSITIONS:
+        row[i] = _to_int(row[i])
+    row[1] = datetime.fromisoformat(f'{row[0]} {row[1]}')
+    row[0] = date.fromisoformat(row[0])
+    if row[10] is None:
+        row[10] = ''
+    return tuple(row)
+
+class LogParser:
+
+    def __init__(self, typed: bool = False) -> None:
+        self.typed      = typed
+        self.getter     = None
+        self.fields     = None
+        self.width      = None
+        self.directive  = False
+        self.rejected   = 0
+
+    def set_fields(self, names, directive: bool = True) -> None:
+        # A trailing None is appended to every split line, so columns the
+        # layout doesn't have are picked up from index -1
+        positions = {FIELD_COLUMNS[name]: i for i, name in enumerate(names)
+                     if name in FIELD_COLUMNS}
+        self.getter     = itemgetter(*(positions.get(column, -1)
+                                       for column in LOG_COLUMNS))
+        self.fields     = tuple(names)
+        self.width      = len(names)
+        self.directive  = directive
+
+    def parse_line(self, line: str):
+        line = line.rstrip('\r\n')
+        if not line:
+            return None
+        if line.startswith('#'):
+            if line.startswith('#Fields:'):
+                self.set_fields(line[8:].split())
+            return None
+        values = line.split(' ')
+        if self.width != len(values):
+            if self.directive or len(values) not in DEFAULT_LAYOUTS:
+                self.rejected += 1
+                return None
+            self.set_fields([name for name, column in FIELD_COLUMNS.items()
+                             if column in DEFAULT_LAYOUTS[len(values)]],
+                            directive=False)
+        values.append(None)
+        record = self.getter(values)
+        if self.typed:
+            return to_etl_1_row(record)
+        return record
+
+    def parse(self, lines):
+        parse_line = self.parse_line
+        for line in lines:
+            record = parse_line(line)
+            if record is not None:
+                yield record
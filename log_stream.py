@@ -0,0 +1,92 @@
+#! /usr/bin/env python3
+
+import bz2
+import zlib
+import codecs
+
+CHUNK_SIZE = 1024 * 1024
+
+# Leading bytes of each supported compressed format
+MAGIC        = {'gzip': b'\x1f\x8b', 'bz2': b'BZh'}
+MAGIC_LENGTH = max(len(magic) for magic in MAGIC.values())
+
+def iter_chunks(body, chunk_size: int = CHUNK_SIZE):
+    while True:
+        chunk = body.read(chunk_size)
+        if not chunk:
+            return
+        yield chunk
+
+def compression_for(key: str):
+    # By object key suffix; None leaves it to iter_lines to sniff
+    if key.endswith('.gz'):
+        return 'gzip'
+    if key.endswith('.bz2'):
+        return 'bz2'
+    return None
+
+def detect_compression(first: bytes):
+    # From the object's first (at least MAGIC_LENGTH) bytes
+    return next((name for name, magic in MAGIC.items() if first.startswith(magic)), None)
+
+def _decompressor(compression: str):
+    if compression == 'gzip':
+        return zlib.decompressobj(zlib.MAX_WBITS | 16)
+    return bz2.BZ2Decompressor()
+
+def iter_decompressed(chunks, compression: str, chunk_size: int = CHUNK_SIZE):
+    # Output is produced at most chunk_size bytes at a time, so an object
+    # that inflates a hundredfold never sits in memory whole. Concatenated
+    # gzip members / bz2 streams (e.g. appended rotations) are read in turn.
+    # An object that ends inside a member raises EOFError, as gzip.decompress
+    # does, instead of passing on the lines read so far as the whole object
+    decompressor = None # between members
+    for chunk in chunks:
+        while chunk or (compression == 'bz2' and decompressor is not None
+                        and not decompressor.needs_input and not decompressor.eof):
+            if decompressor is None:
+                decompressor = _decompressor(compression)
+            data = decompressor.decompress(chunk, chunk_size)
+            if data:
+                yield data
+            if decompressor.eof:
+                chunk        = decompressor.unused_data
+                decompressor = None
+            elif compression == 'gzip':
+                chunk = decompressor.unconsumed_tail
+            else:
+                chunk = b''
+    if decompressor is not None and compression == 'gzip':
+        data = decompressor.flush()
+        if data:
+            yield data
+    if decompressor is not None and not decompressor.eof:
+        raise EOFError(f'{compression} stream ended before the end-of-stream marker')
+
+def _prepend(first: bytes, chunks):
+    if first:
+        yield first
+    yield from chunks
+
+def iter_lines(body, chunk_size: int = CHUNK_SIZE, encoding: str = 'utf-8',
+               compression: str = None):
+    # Only one chunk plus the partial line at its end is held in memory,
+    # so lines are handed on while the rest of the object is still downloading.
+    # compression is 'gzip', 'bz2' or None (detected from the first bytes)
+    chunks = iter_chunks(body, chunk_size)
+    first  = next(chunks, b'')
+    if compression is None:
+        compression = detect_compression(first)
+    chunks = _prepend(first, chunks)
+    if compression is not None:
+        chunks = iter_decompressed(chunks, compression, chunk_size)
+
+    decoder = codecs.getincrementaldecoder(encoding)()
+    pending = ''
+    for chunk in chunks:
+        lines = (pending + decoder.decode(chunk)).split('\n')
+        pending = lines.pop()
+        yield from lines
+    pending += decoder.decode(b'', final=True)
+    if pending:
+        yield pending
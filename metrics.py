@@ -0,0 +1,169 @@
+#! /usr/bin/env python3
+
+import os
+import json
+import time
+import threading
+import functools
+from datetime import datetime
+
+# Progress lines are printed at most once per interval per stage, from
+# whichever thread happens to be counting, so hot loops never touch stdout
+PROGRESS_INTERVAL = float(os.environ.get('METRICS_INTERVAL', 5))
+SUMMARY_PATH      = os.environ.get('METRICS_SUMMARY', 'run_metrics.json')
+COUNT_EVERY       = 1000 # items counted locally before the shared counters are updated
+
+def _duration(seconds: float) -> str:
+    seconds = int(seconds)
+    return f'{seconds // 3600}:{seconds // 60 % 60:02}:{seconds % 60:02}'
+
+class _CountedBody:
+
+    # See Stage.count_read. Reads are chunk-sized, so each one is counted
+
+    def __init__(self, body, stage: 'Stage') -> None:
+        self.body  = body
+        self.stage = stage
+
+    def read(self, size: int = -1) -> bytes:
+        data = self.body.read(size)
+        self.stage.add(bytes=len(data))
+        return data
+
+class Stage:
+
+    # Row (or other unit) and byte counters and wall time for one stage.
+    # Time only runs inside `with stage(...)` blocks (see timed); while
+    # concurrent workers share a stage it runs from the first entry to the
+    # last exit. total is optional; with it the progress lines include an ETA
+
+    def __init__(self, name: str, total: int = None, unit: str = 'rows',
+                 interval: float = PROGRESS_INTERVAL) -> None:
+        self.name       = name
+        self.total      = total
+        self.unit       = unit
+        self.interval   = interval
+        self.rows       = 0
+        self.bytes      = 0
+        self.elapsed    = 0.0  # seconds in closed `with` blocks
+        self.active     = 0    # `with` blocks open right now
+        self.entered    = None # when the open ones began
+        self.printed_at = time.perf_counter()
+        self.lock       = threading.Lock()
+
+    def __enter__(self) -> 'Stage':
+        with self.lock:
+            if self.active == 0:
+                self.entered = time.perf_counter()
+            self.active += 1
+        return self
+
+    def __exit__(self, exc_type, exc_value, exc_trace) -> None:
+        with self.lock:
+            self.active -= 1
+            if self.active == 0:
+                self.elapsed += time.perf_counter() - self.entered
+                self.entered  = None
+
+    def add(self, rows: int = 0, bytes: int = 0) -> None:
+        with self.lock:
+            self.rows  += rows
+            self.bytes += bytes
+            now = time.perf_counter()
+            if now - self.printed_at < self.interval:
+                return
+            self.printed_at = now
+        print(self.progress(now))
+
+    def count_rows(self, items):
+        # Pass-through generator that counts items as they are consumed
+        pending = 0
+        for item in items:
+            yield item
+            pending += 1
+            if pending == COUNT_EVERY:
+                self.add(rows=pending)
+                pending = 0
+        if pending:
+            self.add(rows=pending)
+
+    def count_read(self, body) -> '_CountedBody':
+        # File-like pass-through that counts the bytes read from body, i.e.
+        # as downloaded, before any decompression or decoding
+        return _CountedBody(body, self)
+
+    def seconds(self, now: float = None) -> float:
+        with self.lock:
+            if self.entered is None:
+                return self.elapsed
+            return self.elapsed + (now or time.perf_counter()) - self.entered
+
+    def progress(self, now: float = None) -> str:
+        seconds = self.seconds(now) or 1e-9
+        line    = f'-------- {self.name}: {self.rows:,}'
+        if self.total:
+            line += f' / {self.total:,}'
+        line += f' {self.unit}, {self.rows / seconds:,.0f} {self.unit}/s'
+        if self.bytes:
+            line += f', {self.bytes / seconds / 1e6:,.1f} MB/s'
+        if self.total and self.rows:
+            remaining = max(self.total - self.rows, 0) * seconds / self.rows
+            line += f', ETA {_duration(remaining)}'
+        return line + ' --------'
+
+    def summary(self) -> dict:
+        seconds = self.seconds()
+        return {'unit':          self.unit,
+                'rows':          self.rows,
+                'bytes':         self.bytes,
+                'total':         self.total,
+                'seconds':       round(seconds, 3),
+                'rows_per_sec':  round(self.rows / seconds, 1) if seconds else None,
+                'bytes_per_sec': round(self.bytes / seconds, 1) if seconds else None}
+
+class Metrics:
+
+    def __init__(self) -> None:
+        self.started_at = datetime.utcnow()
+        self.stages     = {}
+        self.lock       = threading.Lock()
+
+    def stage(self, name: str, total: int = None, unit: str = 'rows') -> Stage:
+        # Same Stage for the same name, so concurrent workers share counters
+        with self.lock:
+            if name not in self.stages:
+                self.stages[name] = Stage(name, total, unit)
+            elif total is not None:
+                self.stages[name].total = total
+            return self.stages[name]
+
+    def summary(self, **extra) -> dict:
+        return {'started_at': self.started_at.isoformat(),
+                'stages':     {name: stage.summary() for name, stage in self.stages.items()},
+                **extra}
+
+    def write_summary(self, path: str = SUMMARY_PATH, **extra) -> dict:
+        summary = self.summary(**extra)
+        with open(path, 'w') as summary_file:
+            json.dump(summary, summary_file, indent=2, default=str)
+        print(f'-------- Run summary written to {path} --------')
+        return summary
+
+# Shared by every module in the process
+metrics = Metrics()
+
+def stage(name: str, total: int = None, unit: str = 'rows') -> Stage:
+    return metrics.stage(name, total, unit)
+
+def timed(name: str, unit: str = 'rows'):
+    # Decorator: the function's run time is the stage's time
+    def decorate(function):
+        @functools.wraps(function)
+        def run(*args, **kwargs):
+            with stage(name, unit=unit):
+                return function(*args, **kwargs)
+        return run
+    return decorate
+
+def write_summary(path: str = SUMMARY_PATH, **extra) -> dict:
+    return metrics.write_summary(path, **extra)
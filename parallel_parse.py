@@ -0,0 +1,165 @@
+#! /usr/bin/env python3
+
+import os
+import mmap
+import threading
+from concurrent.futures import ProcessPoolExecutor
+from log_parser import LogParser
+
+PARSE_WORKERS = int(os.environ.get('PARSE_WORKERS', os.cpu_count() or 1))
+RANGE_BYTES   = 32 * 1024 * 1024 # target size of one parse task
+PROBE_BYTES   = 64 * 1024        # read past a split point to find the next newline
+
+class LocalSource:
+
+    # Byte ranges of a local file, memory-mapped once per process
+
+    def __init__(self, path: str) -> None:
+        self.path   = path
+        self.buffer = None
+
+    def __getstate__(self) -> dict:
+        return {'path': self.path, 'buffer': None}
+
+    def size(self) -> int:
+        return os.path.getsize(self.path)
+
+    def read(self, start: int, end: int) -> bytes:
+        if self.buffer is None:
+            with open(self.path, 'rb') as log_file:
+                self.buffer = mmap.mmap(log_file.fileno(), 0, access=mmap.ACCESS_READ)
+        return self.buffer[start:end]
+
+_clients = {}
+
+class S3Source:
+
+    # Byte ranges of an S3 object via ranged GETs. client_factory must be a
+    # module-level function (it is sent to the worker processes, which each
+    # create their own client)
+
+    def __init__(self, client_factory, bucket: str, key: str) -> None:
+        self.client_factory = client_factory
+        self.bucket         = bucket
+        self.key            = key
+
+    def client(self):
+        if self.client_factory not in _clients:
+            _clients[self.client_factory] = self.client_factory()
+        return _clients[self.client_factory]
+
+    def size(self) -> int:
+        return self.client().head_object(Bucket=self.bucket, Key=self.key)['ContentLength']
+
+    def read(self, start: int, end: int) -> bytes:
+        if end <= start:
+            return b''
+        return self.client().get_object(Bucket=self.bucket, Key=self.key,
+                                        Range=f'bytes={start}-{end - 1}')['Body'].read()
+
+def split_ranges(source, size: int, count: int) -> list:
+    # count roughly equal (start, end) ranges, each ending just after a newline
+    # so that no line is split between two workers
+    bounds = [0]
+    for i in range(1, count):
+        offset = max(size * i // count, bounds[-1])
+        while offset < size:
+            probe   = source.read(offset, min(offset + PROBE_BYTES, size))
+            newline = probe.find(b'\n')
+            if newline >= 0:
+                offset += newline + 1
+                break
+            offset += len(probe)
+        if bounds[-1] < offset < size:
+            bounds.append(offset)
+    bounds.append(size)
+    return list(zip(bounds, bounds[1:]))
+
+def parse_range(source, start: int, end: int, fields, typed: bool = False,
+                encoding: str = 'utf-8') -> tuple:
+    # Parses one range as if `fields` (a #Fields: list, or None for the
+    # headerless fallback) were in effect at its start. Returns the records,
+    # whether any of them were parsed under that assumption (i.e. before the
+    # range's own first #Fields: line), the range's last #Fields: list and
+    # the number of malformed lines. Lines rejected under the assumption
+    # count as parsed under it too: they may be valid
+    parser    = LogParser(typed=typed)
+    if fields is not None:
+        parser.set_fields(fields)
+    records   = []
+    assumed   = False
+    directive = None
+    for line in source.read(start, end).decode(encoding).split('\n'):
+        if line.startswith('#'):
+            if line.startswith('#Fields:'):
+                parser.parse_line(line)
+                directive = parser.fields
+            continue
+        if directive is None and line.strip('\r'):
+            assumed = True
+        record = parser.parse_line(line)
+        if record is not None:
+            records.append(record)
+    return records, assumed, directive, parser.rejected
+
+def _header_fields(source, size: int, encoding: str = 'utf-8'):
+    # The #Fields: line heading the file, assumed for every range up front
+    for line in source.read(0, min(PROBE_BYTES, size)).decode(encoding, 'ignore').split('\n'):
+        if line.startswith('#Fields:'):
+            return tuple(line[8:].split())
+        if line.strip('\r') and not line.startswith('#'):
+            return None
+    return None
+
+_pools      = {}
+_pools_lock = threading.Lock()
+
+def _pool(workers: int) -> ProcessPoolExecutor:
+    # One pool per worker count for the life of the process, shared by the
+    # ingest threads, so worker start-up is paid once
+    with _pools_lock:
+        if workers not in _pools:
+            _pools[workers] = ProcessPoolExecutor(max_workers=workers)
+        return _pools[workers]
+
+def parse_source(source, workers: int = PARSE_WORKERS, typed: bool = False,
+                 range_bytes: int = RANGE_BYTES, encoding: str = 'utf-8', counts: dict = None):
+    # Yields lists of records, in file order. Ranges are parsed under the
+    # #Fields: header believed to be in effect when they are submitted (the
+    # file's first one to begin with). Results are consumed in order, so the
+    # header actually in effect at each range is known by then; a range whose
+    # records depended on a wrong guess is parsed again, and the ranges still
+    # in flight are resubmitted under the corrected header. At most
+    # 2 * workers ranges are in flight, so memory stays bounded. Malformed
+    # lines are added up in counts['rejected'], if counts is given
+    size = source.size()
+    if size == 0:
+        return
+    ranges  = split_ranges(source, size, max(workers, -(-size // range_bytes)))
+    pool    = _pool(workers)
+    guess   = _header_fields(source, size, encoding)
+    fields  = None # in effect at the start of range i
+    futures = []   # (future, fields it was parsed under) per submitted range
+
+    def submit(i, assumed):
+        return pool.submit(parse_range, source, *ranges[i], assumed, typed, encoding), assumed
+
+    for i in range(len(ranges)):
+        while len(futures) < len(ranges) and len(futures) < i + 2 * workers:
+            futures.append(submit(len(futures), guess))
+        future, assumed = futures[i]
+        records, guessed, directive, rejected = future.result()
+        futures[i] = None
+        if guessed and assumed != fields:
+            records, _, directive, rejected = submit(i, fields)[0].result()
+        if counts is not None:
+            counts['rejected'] = counts.get('rejected', 0) + rejected
+        if directive is not None:
+            fields = directive
+        if fields != guess:
+            guess = fields
+            for j in range(i + 1, len(futures)):
+                if futures[j][1] != guess:
+                    futures[j][0].cancel()
+                    futures[j] = submit(j, guess)
+        yield records
@@ -0,0 +1,128 @@
+#! /usr/bin/env python3
+
+import io
+import os
+import uuid
+from itertools import groupby
+from bulk_load import iter_batches, copy_rows
+from log_parser import LOG_COLUMNS, INT_COLUMNS
+from dimensions import FACT_KEY_COLUMNS, fact_keys
+
+# pyarrow is only needed for LOAD_MODE=parquet
+try:
+    import pyarrow
+    import pyarrow.parquet
+except ImportError:
+    pyarrow = None
+
+ROWS_PER_FILE = 1000000
+
+def etl_1_columns(with_keys: bool = False) -> tuple:
+    # Column order of the files: etl_1 rows as redshift_etl_1 would write them
+    columns = ('id', *LOG_COLUMNS, 'load_batch_id')
+    if with_keys:
+        columns += tuple(FACT_KEY_COLUMNS.values())
+    return columns
+
+def parquet_schema(columns) -> 'pyarrow.Schema':
+    if pyarrow is None:
+        raise RuntimeError('LOAD_MODE=parquet needs pyarrow (pip install pyarrow)')
+    types = {'date': pyarrow.date32(), 'time': pyarrow.timestamp('us'),
+             'load_batch_id': pyarrow.int64(),
+             **{column: pyarrow.int32() for column in INT_COLUMNS}}
+    return pyarrow.schema([(column, types.get(column, pyarrow.string()))
+                           for column in columns])
+
+def etl_1_records(rows, load_batch_id: int, with_keys: bool = False):
+    # Typed records (see log_parser.to_etl_1_row) -> full etl_1 rows, so
+    # casting and the cookie normalization happen once, at parse time
+    for row in rows:
+        keys = fact_keys(row) if with_keys else ()
+        yield (str(uuid.uuid4()), *row, load_batch_id, *keys)
+
+def encode_parquet(rows, schema) -> bytes:
+    table = pyarrow.Table.from_pylist([dict(zip(schema.names, row)) for row in rows],
+                                      schema=schema)
+    data  = io.BytesIO()
+    pyarrow.parquet.write_table(table, data, compression='snappy')
+    return data.getvalue()
+
+def s3_writer(s3_client, bucket: str):
+    def write(key: str, data: bytes) -> str:
+        s3_client.put_object(Bucket=bucket, Key=key, Body=data)
+        return f's3://{bucket}/{key}'
+    return write
+
+def local_writer(directory: str):
+    def write(key: str, data: bytes) -> str:
+        path = os.path.join(directory, key)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(path, 'wb') as parquet_file:
+            parquet_file.write(data)
+        return path
+    return write
+
+def batch_prefix(prefix: str, load_batch_id: int) -> str:
+    return f'{prefix}load_batch={load_batch_id}/'
+
+def write_batch(batch: list, columns, write, prefix: str, load_batch_id: int,
+                part: int) -> list:
+    # One file per log date in the batch:
+    # {prefix}load_batch=N/date=YYYY-MM-DD/part-NNNNN.parquet
+    schema   = parquet_schema(columns)
+    date_pos = columns.index('date')
+    written  = []
+    batch.sort(key=lambda record: record[date_pos])
+    for log_date, rows in groupby(batch, key=lambda record: record[date_pos]):
+        key = (f'{batch_prefix(prefix, load_batch_id)}date={log_date.isoformat()}'
+               f'/part-{part:05}.parquet')
+        written.append(write(key, encode_parquet(list(rows), schema)))
+    return written
+
+def write_partitions(records, columns, write, prefix: str, load_batch_id: int,
+                     rows_per_file: int = ROWS_PER_FILE) -> list:
+    # At most rows_per_file records are held in memory at once
+    written = []
+    for part, batch in enumerate(iter_batches(records, rows_per_file)):
+        written += write_batch(batch, columns, write, prefix, load_batch_id, part)
+    return written
+
+def copy_parquet(cursor, table: str, columns, uri: str, iam_role: str) -> int:
+    # COPY ... FORMAT AS PARQUET maps file columns by position, so the files
+    # go into a temp table of exactly their columns and on from there. The
+    # temp table is only dropped on success; a rollback removes it otherwise
+    stage = f'stage_{table.split(".")[-1]}_parquet'
+    cursor.execute(rf"""CREATE TEMP TABLE {stage} AS
+                        SELECT {', '.join(columns)} FROM {table} WHERE 1 = 0""")
+    cursor.execute(rf"""COPY {stage}
+                        FROM '{uri}'
+                        IAM_ROLE '{iam_role}'
+                        FORMAT AS PARQUET""")
+    cursor.execute(rf"""INSERT INTO {table} ({', '.join(columns)})
+                        SELECT {', '.join(columns)} FROM {stage}""")
+    inserted = cursor.rowcount
+    cursor.execute(rf"""DROP TABLE {stage}""")
+    return inserted
+
+def export_and_load(cursor, rows, load_batch_id: int, with_keys: bool = False,
+                    s3_client=None, bucket: str = None, prefix: str = 'parquet/',
+                    iam_role: str = None, directory: str = None,
+                    rows_per_file: int = ROWS_PER_FILE) -> int:
+    # Typed rows -> Parquet files -> public.etl_1. On Redshift (iam_role set)
+    # the files are staged in S3 and COPY'd; without it (local Postgres,
+    # which can't read Parquet) they are written to `directory` and the same
+    # records are streamed in with COPY FROM STDIN
+    columns = etl_1_columns(with_keys)
+    if iam_role:
+        write_partitions(etl_1_records(rows, load_batch_id, with_keys), columns,
+                         s3_writer(s3_client, bucket), prefix, load_batch_id, rows_per_file)
+        return copy_parquet(cursor, 'public.etl_1', columns,
+                            f's3://{bucket}/{batch_prefix(prefix, load_batch_id)}', iam_role)
+
+    total = 0
+    for part, batch in enumerate(iter_batches(etl_1_records(rows, load_batch_id, with_keys),
+                                              rows_per_file)):
+        if directory:
+            write_batch(batch, columns, local_writer(directory), prefix, load_batch_id, part)
+        total += copy_rows(cursor, 'public.etl_1', columns, batch)
+    return total
@@ -0,0 +1,163 @@
+#! /usr/bin/env python3
+
+######## Runs the whole pipeline: s3_load -> etl_1 -> dimensions -> fact keys -> rollups, ########
+######## with sessionization alongside the dimensions. ########
+######## Stages whose dependencies are done run concurrently (the dimension ########
+######## builders), and a failed run can be resumed from the stage that failed. ########
+
+import os
+import sys
+import json
+import time
+import argparse
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+import s3_to_redshift
+import redshift_etl_1
+import redshift_etl_2
+import rollups
+import sessionize
+from redshift_connect import pool_stats
+from metrics import write_summary
+from sql_trace import report_trace
+
+# One thread per dimension builder, plus one for the sessionizer running alongside them
+PIPELINE_WORKERS = int(os.environ.get('PIPELINE_WORKERS', len(redshift_etl_2.DIMENSION_LOADERS) + 1))
+PIPELINE_STATE   = os.environ.get('PIPELINE_STATE', 'pipeline_run.json')
+
+def run_s3_load(state: dict) -> None:
+    s3_to_redshift.main()
+
+def run_etl_1(state: dict) -> None:
+    redshift_etl_1.main()
+
+def plan_etl_2(state: dict) -> None:
+    # Fixed once per run and saved, so a resumed run finishes the same batches
+    redshift_etl_2.create_table()
+    state['batches'] = redshift_etl_2.new_batches()
+
+def dimension_stage(dimension: str):
+    def run(state: dict) -> None:
+        if state['batches'] is None or dimension not in redshift_etl_2.dimensions_to_build():
+            return
+        redshift_etl_2.DIMENSION_LOADERS[dimension](tuple(state['batches']))
+    return run
+
+def run_fact_keys(state: dict) -> None:
+    if state['batches'] is None:
+        print('-------- No new load batches --------')
+        return
+    batches = tuple(state['batches'])
+    redshift_etl_2.key_facts(batches)
+    redshift_etl_2.mark_processed(batches)
+
+def run_sessions(state: dict) -> None:
+    sessionize.main()
+
+def run_rollups(state: dict) -> None:
+    # Catches up with every batch etl_2 has keyed, not only this run's
+    rollups.main()
+
+DIMENSION_STAGES = tuple(f'dim_{dimension}' for dimension in redshift_etl_2.DIMENSION_LOADERS)
+
+# stage -> (stages it depends on, function)
+STAGES = {'s3_load':    ((), run_s3_load),
+          'etl_1':      (('s3_load',), run_etl_1),
+          'etl_2_plan': (('etl_1',), plan_etl_2),
+          **{stage: (('etl_2_plan',), dimension_stage(dimension))
+             for stage, dimension in zip(DIMENSION_STAGES, redshift_etl_2.DIMENSION_LOADERS)},
+          'sessions':   (('etl_1',), run_sessions),
+          'fact_keys':  ((*DIMENSION_STAGES, 'sessions'), run_fact_keys),
+          'rollups':    (('fact_keys',), run_rollups)}
+
+class PipelineError(Exception):
+    pass
+
+def load_state(path: str, resume: bool) -> dict:
+    if resume and os.path.exists(path):
+        with open(path) as state_file:
+            return json.load(state_file)
+    return {'completed': [], 'batches': None}
+
+def save_state(path: str, state: dict) -> None:
+    # Written to a temporary file first so a crash never leaves half a file
+    with open(path + '.tmp', 'w') as state_file:
+        json.dump(state, state_file)
+    os.replace(path + '.tmp', path)
+
+def timed(function, state: dict) -> float:
+    start = time.perf_counter()
+    function(state)
+    return time.perf_counter() - start
+
+def run_stages(stages: dict, state: dict, workers: int, on_complete) -> dict:
+    # Starts every stage whose dependencies have completed, as soon as they
+    # have; after a failure nothing new is started, the running stages are
+    # allowed to finish and PipelineError names the failed ones
+    done    = set(state['completed'])
+    pending = [name for name in stages if name not in done]
+    running = {}
+    failed  = []
+    timings = {}
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        while running or (pending and not failed):
+            if not failed:
+                for name in [name for name in pending if set(stages[name][0]) <= done]:
+                    pending.remove(name)
+                    running[pool.submit(timed, stages[name][1], state)] = name
+                    print(f'-------- Started {name} --------')
+            if not running:
+                raise PipelineError(f'Stages with unmet dependencies: {pending}')
+            finished, _ = wait(running, return_when=FIRST_COMPLETED)
+            for future in finished:
+                name = running.pop(future)
+                try:
+                    timings[name] = future.result()
+                except BaseException as err: # scripts sys.exit() on bad config
+                    print(f'Error in stage {name}: ', err)
+                    failed.append(name)
+                    continue
+                print(f'-------- Finished {name} in {timings[name]:.2f} s --------')
+                done.add(name)
+                state['completed'].append(name)
+                on_complete(state)
+    if failed:
+        raise PipelineError(f'Failed stages: {", ".join(failed)}')
+    return timings
+
+def main(argv=None) -> None:
+    parser = argparse.ArgumentParser(description='Run the ETL pipeline')
+    parser.add_argument('--workers', type=int, default=PIPELINE_WORKERS,
+                        help='stages run at the same time (default: %(default)s)')
+    parser.add_argument('--state-file', default=PIPELINE_STATE,
+                        help='progress of the current run (default: %(default)s)')
+    parser.add_argument('--resume', action='store_true',
+                        help='skip the stages a failed run already completed')
+    args = parser.parse_args(argv)
+
+    state = load_state(args.state_file, args.resume)
+    if state['completed']:
+        print(f'-------- Resuming after: {", ".join(state["completed"])} --------')
+    start = time.perf_counter()
+    try:
+        timings = run_stages(STAGES, state, args.workers,
+                             lambda state: save_state(args.state_file, state))
+    except PipelineError as err:
+        save_state(args.state_file, state)
+        print(f'[ERROR]: {err}; rerun with --resume to continue')
+        sys.exit(1)
+    if os.path.exists(args.state_file):
+        os.remove(args.state_file)
+
+    dimension_times = [timings[stage] for stage in DIMENSION_STAGES if stage in timings]
+    if dimension_times:
+        print(f'-------- Dimensions: slowest {max(dimension_times):.2f} s, '
+              f'sum {sum(dimension_times):.2f} s --------')
+    print(f'-------- Pipeline finished in {time.perf_counter() - start:.2f} s --------')
+    print('-------- Connection pool: ', pool_stats(redshift_etl_2.redshift_db_config), ' --------')
+    write_summary(pipeline={name: round(seconds, 3) for name, seconds in timings.items()},
+                  pool=pool_stats(redshift_etl_2.redshift_db_config))
+    report_trace()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,95 @@
+#! /usr/bin/env python3
+
+import os
+from datetime import datetime, timedelta
+
+# public.pipeline_state holds one row per stage: the highest load batch the
+# stage has committed. 'load_batch' is the last batch id handed out.
+# public.load_batch_claims holds the batch ids handed out whose load hasn't
+# committed (or failed) yet; no stage reads past the oldest of them, since
+# concurrent loads commit out of order. A claim older than
+# LOAD_CLAIM_TIMEOUT_HOURS is taken to belong to a loader that died
+CLAIM_TIMEOUT = timedelta(hours=float(os.environ.get('LOAD_CLAIM_TIMEOUT_HOURS', 24)))
+
+def create_state_table(cursor) -> None:
+    cursor.execute(rf"""CREATE TABLE IF NOT EXISTS public.pipeline_state (
+                        stage VARCHAR(50),
+                        watermark BIGINT,
+                        updated_at TIMESTAMP)""")
+    cursor.execute(rf"""CREATE TABLE IF NOT EXISTS public.load_batch_claims (
+                        load_batch_id BIGINT,
+                        claimed_at TIMESTAMP)""")
+
+def has_column(cursor, table: str, column: str) -> bool:
+    schema, name = table.split('.')
+    cursor.execute(rf"""SELECT 1 FROM information_schema.columns
+                        WHERE table_schema = %s AND table_name = %s
+                            AND column_name = %s""", (schema, name, column))
+    return cursor.fetchone() is not None
+
+def add_column(cursor, table: str, column: str, column_type: str) -> None:
+    # Redshift has no ADD COLUMN IF NOT EXISTS
+    if not has_column(cursor, table, column):
+        cursor.execute(rf"""ALTER TABLE {table} ADD COLUMN {column} {column_type}""")
+
+# Key columns that replaced older ones. CREATE TABLE IF NOT EXISTS leaves a
+# table from before the change as it is, and keying against it would fail
+# or mismatch, so it is refused rather than worked around
+REPLACED_COLUMNS = {'public.dim_time':    ('second_of_day', 'time_id'),
+                    'public.dim_request': ('duration_bucket', 'request_id')}
+
+def check_columns(cursor) -> None:
+    for table, (column, fact_key) in REPLACED_COLUMNS.items():
+        if not has_column(cursor, table, column):
+            raise RuntimeError(f'{table} predates its {column} column: drop it so it is '
+                               f'recreated, and reset etl_1.{fact_key} to NULL on rows '
+                               f'to re-key')
+
+def get_watermark(cursor, stage: str) -> int:
+    cursor.execute(rf"""SELECT watermark FROM public.pipeline_state
+                        WHERE stage = %s""", (stage,))
+    row = cursor.fetchone()
+    return row[0] if row else 0
+
+def set_watermark(cursor, stage: str, watermark: int) -> None:
+    cursor.execute(rf"""UPDATE public.pipeline_state
+                        SET watermark = %s, updated_at = %s
+                        WHERE stage = %s""", (watermark, datetime.utcnow(), stage))
+    if cursor.rowcount == 0:
+        cursor.execute(rf"""INSERT INTO public.pipeline_state(stage, watermark, updated_at)
+                            VALUES (%s, %s, %s)""", (stage, watermark, datetime.utcnow()))
+
+def next_batch_id(cursor) -> int:
+    # Run in its own short transaction: the lock serialises concurrent
+    # loaders. The batch stays claimed until release_batch
+    cursor.execute(rf"""LOCK public.pipeline_state""")
+    batch_id = get_watermark(cursor, 'load_batch') + 1
+    set_watermark(cursor, 'load_batch', batch_id)
+    cursor.execute(rf"""INSERT INTO public.load_batch_claims(load_batch_id, claimed_at)
+                        VALUES (%s, %s)""", (batch_id, datetime.utcnow()))
+    return batch_id
+
+def release_batch(cursor, batch_id: int) -> None:
+    # In the transaction that commits the batch's rows, or on its own once
+    # the load has failed and been rolled back
+    cursor.execute(rf"""DELETE FROM public.load_batch_claims
+                        WHERE load_batch_id = %s""", (batch_id,))
+
+def pending_batches(cursor, stage: str, source_table: str):
+    # (last committed batch, newest batch in source_table] for this stage.
+    # The upper bound is fixed up front, so rows that arrive while the stage
+    # runs are left for the next run instead of being skipped, and it stays
+    # below the oldest batch still being loaded, so a batch that commits
+    # after a newer one isn't passed over. Returns None when there is
+    # nothing new.
+    low = get_watermark(cursor, stage)
+    cursor.execute(rf"""SELECT MIN(load_batch_id) FROM public.load_batch_claims
+                        WHERE claimed_at > %s""", (datetime.utcnow() - CLAIM_TIMEOUT,))
+    loading = cursor.fetchone()[0]
+    cursor.execute(rf"""SELECT MAX(load_batch_id) FROM {source_table}
+                        WHERE load_batch_id > %s
+                            AND (load_batch_id < %s OR %s IS NULL)""", (low, loading, loading))
+    high = cursor.fetchone()[0]
+    if high is None:
+        return None
+    return low, high
@@ -1,18 +1,138 @@
 #! /usr/bin/env python3
 
+import atexit
+import threading
 import psycopg2
+from psycopg2.extensions import STATUS_READY
+from sql_trace import TracingCursor, SQL_TRACE
+
+POOL_MAXCONN = 8
+
+class RedshiftPool:
+
+    def __init__(self, config: dict, maxconn: int = POOL_MAXCONN) -> None:
+        self.configuration = config
+        self.maxconn       = maxconn
+        self.idle          = []
+        self.in_use        = 0
+        self.lock          = threading.Condition()
+        self.counters      = {'opened': 0, 'reused': 0, 'waits': 0,
+                              'discarded': 0, 'peak_in_use': 0}
+
+    def getconn(self) -> 'connection':
+        with self.lock:
+            # Block rather than fail when every connection is checked out
+            while not self.idle and self.in_use >= self.maxconn:
+                self.counters['waits'] += 1
+                self.lock.wait()
+            self.in_use += 1
+            self.counters['peak_in_use'] = max(self.counters['peak_in_use'], self.in_use)
+            while self.idle:
+                conn = self.idle.pop()
+                if not conn.closed:
+                    self.counters['reused'] += 1
+                    return conn
+                self.counters['discarded'] += 1
+        try:
+            conn = psycopg2.connect(**self.configuration)
+        except Exception:
+            with self.lock:
+                self.in_use -= 1
+                self.lock.notify()
+            raise
+        with self.lock:
+            self.counters['opened'] += 1
+        return conn
+
+    def putconn(self, conn: 'connection') -> None:
+        # Never hand out a connection that is still inside a transaction
+        if not conn.closed and conn.status != STATUS_READY:
+            try:
+                conn.rollback()
+            except psycopg2.Error:
+                conn.close()
+        with self.lock:
+            self.in_use -= 1
+            if conn.closed:
+                self.counters['discarded'] += 1
+            else:
+                self.idle.append(conn)
+            self.lock.notify()
+
+    def closeall(self) -> None:
+        with self.lock:
+            for conn in self.idle:
+                conn.close()
+            self.idle = []
+
+    def stats(self) -> dict:
+        with self.lock:
+            return {**self.counters, 'in_use': self.in_use, 'idle': len(self.idle)}
+
+_pools      = {}
+_pools_lock = threading.Lock()
+_active     = threading.local()
+
+def _pool_key(config: dict) -> tuple:
+    return tuple(sorted((key, str(value)) for key, value in config.items()))
+
+def get_pool(config: dict) -> RedshiftPool:
+    with _pools_lock:
+        key = _pool_key(config)
+        if key not in _pools:
+            _pools[key] = RedshiftPool(config)
+        return _pools[key]
+
+def pool_stats(config: dict) -> dict:
+    return get_pool(config).stats()
+
+@atexit.register
+def close_pools() -> None:
+    with _pools_lock:
+        for pool in _pools.values():
+            pool.closeall()
 
 class UseRedshift:
 
-    def __init__(self, config: dict) -> None:
+    # Each outermost `with` block is one transaction on a pooled connection:
+    # committed on success, rolled back on an exception. `with` blocks nested
+    # inside it on the same thread (e.g. several stages called from one
+    # `with UseRedshift(config):`) share its connection and transaction.
+    # With trace=True (SQL_TRACE=1) the cursor is a sql_trace.TracingCursor.
+
+    def __init__(self, config: dict, pooled: bool = True, trace: bool = SQL_TRACE) -> None:
         self.configuration = config
+        self.pooled        = pooled
+        self.trace         = trace
 
     def __enter__(self) -> 'cursor':
-        self.conn = psycopg2.connect(**self.configuration)
-        self.cursor = self.conn.cursor()
+        key    = _pool_key(self.configuration)
+        active = getattr(_active, 'connections', None)
+        if active is None:
+            active = _active.connections = {}
+        self.owner = key not in active
+        if self.owner:
+            if self.pooled:
+                active[key] = get_pool(self.configuration).getconn()
+            else:
+                active[key] = psycopg2.connect(**self.configuration)
+        self.key    = key
+        self.conn   = active[key]
+        self.cursor = self.conn.cursor(cursor_factory=TracingCursor if self.trace else None)
         return self.cursor
 
     def __exit__(self, exc_type, exc_value, exc_trace) -> None:
-        self.conn.commit()
         self.cursor.close()
-        self.conn.close()
+        if not self.owner:
+            return
+        del _active.connections[self.key]
+        try:
+            if exc_type is None:
+                self.conn.commit()
+            else:
+                self.conn.rollback()
+        finally:
+            if self.pooled:
+                get_pool(self.configuration).putconn(self.conn)
+            else:
+                self.conn.close()
@@ -5,7 +5,16 @@ import sys
 import uuid
 import psycopg2
 import boto3
-from redshift_connect import UseRedshift
+from redshift_connect import UseRedshift, pool_stats
+from log_parser import to_etl_1_row, LOG_COLUMNS
+from user_agent import classify_many, crawler_sql
+from bulk_load import insert_values
+from dimensions import FACT_KEY_COLUMNS, fact_keys, natural_keys, dimension_key_sql
+from dim_cache import DimensionCache
+from pipeline_state import create_state_table, add_column, pending_batches, set_watermark
+from metrics import stage, timed, write_summary
+from sql_trace import report_trace
+from redshift_etl_2 import create_table as create_dimension_tables, new_dimension_id, resolve_client_ips
 
 aws_access_key = os.environ.get('AWS_ACCESS_KEY')
 aws_secret_key = os.environ.get('AWS_SECRET_KEY')
@@ -15,6 +24,21 @@ redshift_pw    = os.environ.get('REDSHIFT_PW')
 redshift_endpt = os.environ.get('REDSHIFT_ENDPT')
 redshift_port  = os.environ.get('REDSHIFT_PORT')
 
+# 'insert' writes one row per statement, 'batched' streams s3_load through
+# a server-side cursor and writes ETL_BATCH_SIZE rows per statement,
+# 'sql' runs the whole stage as one INSERT ... SELECT inside the warehouse
+etl_mode       = os.environ.get('ETL_1_MODE', 'insert')
+etl_batch_size = int(os.environ.get('ETL_BATCH_SIZE', 10000))
+# 'hash' fills date_id ... visit_id here from deterministic natural-key
+# hashes, so redshift_etl_2 doesn't have to join them back in. 'cache'
+# resolves them through in-memory dimension caches (DIM_CACHE_SIZE members
+# each) and writes new dimension members in the same pass
+key_mode       = os.environ.get('KEY_MODE', 'uuid')
+dim_cache_size = int(os.environ.get('DIM_CACHE_SIZE', 1000000))
+# SKIP_CRAWLERS=1 leaves requests from known bots (see user_agent.py) out of
+# etl_1 altogether; they stay in s3_load
+skip_crawlers  = os.environ.get('SKIP_CRAWLERS', '0') not in ('', '0')
+
 if all(x in os.environ for x in ['AWS_ACCESS_KEY', 'AWS_SECRET_KEY', 
                                 'DB_NAME', 'REDSHIFT_USER', 
                                 'REDSHIFT_PW', 'REDSHIFT_ENDPT',
@@ -50,6 +74,8 @@ def create_table():
                     request_id VARCHAR(50), 
                     file_id VARCHAR(50), 
                     visit_id VARCHAR(50),
+                    user_agent_id VARCHAR(50),
+                    session_id VARCHAR(50),
                     date DATE, 
                     time TIMESTAMP, 
                     server_ip VARCHAR(20), 
@@ -68,128 +94,187 @@ def create_table():
                     bytes_sent INT, 
                     bytes_received INT, 
                     duration INT, 
-                    in_etl_2 BOOLEAN)""" 
+                    in_etl_2 BOOLEAN, 
+                    load_batch_id BIGINT)""" 
 
         try:
             print('-------- Executing CREATE TABLE --------')
             cursor.execute(SQL_CREATE)
+            add_column(cursor, 'public.etl_1', 'load_batch_id', 'BIGINT')
+            add_column(cursor, 'public.etl_1', 'user_agent_id', 'VARCHAR(50)')
+            add_column(cursor, 'public.etl_1', 'session_id', 'VARCHAR(50)')
+            create_state_table(cursor)
             print('-------- SQL CREATE Complete --------')
         except Exception as err:
             print('Error executing SQL: ', err)
 
+ETL_1_COLUMNS = ('id', *LOG_COLUMNS, 'load_batch_id')
+if key_mode in ('hash', 'cache'):
+    ETL_1_COLUMNS += tuple(FACT_KEY_COLUMNS.values())
+
+def load_dimension_caches(cursor) -> dict:
+    create_dimension_tables()
+    caches = {}
+    for dimension in FACT_KEY_COLUMNS:
+        caches[dimension] = DimensionCache(dimension, new_dimension_id, dim_cache_size,
+                                           locate=resolve_client_ips)
+        caches[dimension].load(cursor)
+    return caches
+
+CLIENT_BROWSER = LOG_COLUMNS.index('client_browser')
+
+def without_crawlers(logs) -> list:
+    crawlers = classify_many(log[CLIENT_BROWSER] for log in logs)
+    kept     = [log for log, crawler in zip(logs, crawlers) if not crawler]
+    stage('crawlers_skipped').add(rows=len(logs) - len(kept))
+    return kept
+
+def etl_1_rows(cursor, logs, caches=None) -> list:
+    # s3_load log fields + load_batch_id -> values for ETL_1_COLUMNS
+    if skip_crawlers:
+        logs = without_crawlers(logs)
+    new_rows = [to_etl_1_row(log) for log in logs]
+    if key_mode == 'hash':
+        return [(str(uuid.uuid4()), *new_row, log[-1], *fact_keys(new_row))
+                for new_row, log in zip(new_rows, logs)]
+    if key_mode == 'cache':
+        keys    = list(zip(*map(natural_keys, new_rows)))
+        key_ids = [caches[dimension].resolve_many(cursor, dimension_keys)
+                   for dimension, dimension_keys in zip(FACT_KEY_COLUMNS, keys)]
+        for cache in caches.values():
+            cache.flush(cursor)
+        return [(str(uuid.uuid4()), *new_row, log[-1], *ids)
+                for new_row, log, ids in zip(new_rows, logs, zip(*key_ids))]
+    return [(str(uuid.uuid4()), *new_row, log[-1]) for new_row, log in zip(new_rows, logs)]
+
+SELECT_S3_LOAD = rf"""SELECT {', '.join(LOG_COLUMNS)}, load_batch_id
+                    FROM public.s3_load
+                    WHERE load_batch_id > %s AND load_batch_id <= %s"""
+
+def new_batches(cursor):
+    # Load batches that arrived since this stage's last committed watermark
+    batches = pending_batches(cursor, 'etl_1', 'public.s3_load')
+    if batches is None:
+        print('-------- No new load batches --------')
+    return batches
+
+def etl_1_stage(cursor, batches):
+    # Row count up front so the progress lines can show an ETA
+    cursor.execute(rf"""SELECT COUNT(*) FROM public.s3_load
+                        WHERE load_batch_id > %s AND load_batch_id <= %s""", batches)
+    return stage('etl_1', total=cursor.fetchone()[0])
+
+@timed('etl_1')
 def insert_into_table():
     with UseRedshift(redshift_db_config) as cursor:
+        batches = new_batches(cursor)
+        if batches is None:
+            return
+        caches = load_dimension_caches(cursor) if key_mode == 'cache' else None
 
         # Select all if not already present in public.etl_1 table
-        cursor.execute(rf"""SELECT * FROM public.s3_load WHERE in_etl_1 = False""")
-
-        in_etl_2_flag = False
+        cursor.execute(SELECT_S3_LOAD, batches)
 
         logs = cursor.fetchall()
+        etl_stage = stage('etl_1', total=len(logs))
         for single_log in logs:
-            if len(single_log) == 19:
-                new_row = []
-                new_row.append(single_log[0]) # append date
-                new_timestamp = single_log[0:2]
-                new_timestamp = " ".join(new_timestamp)
-                new_row.append(new_timestamp) # append timestamp
-                new_row.append(single_log[2]) # append server_ip
-                new_row.append(single_log[3]) # append method
-                new_row.append(single_log[4]) # append uri_stem
-                new_row.append(single_log[5]) # append uri_query
-                server_port = int(single_log[6])
-                new_row.append(server_port) # append server_port
-                new_row.append(single_log[7]) # append username
-                new_row.append(single_log[8]) # append client_ip
-                new_row.append(single_log[9]) # append client_browser
-                if single_log[10] == None:
-                    new_row.append('')
-                else:
-                    new_row.append(single_log[10]) # append client_cookie
-                new_row.append(single_log[11]) # append client_referrer
-                status = int(single_log[12])
-                new_row.append(status) # append status
-                sub_status = int(single_log[13])
-                new_row.append(sub_status) # append sub_status
-                win32_status = int(single_log[14])
-                new_row.append(win32_status) # append win32_status
-                if single_log[15] == None:
-                    new_row.append(single_log[15]) # append bytes_sent
-                else:
-                    bytes_sent = int(single_log[15])
-                    new_row.append(bytes_sent) # append bytes_sent
-                if single_log[16] == None:
-                    new_row.append(single_log[16])
-                else:
-                    bytes_received = int(single_log[16])
-                    new_row.append(bytes_received) # append bytes_received
-                duration = int(single_log[17])
-                new_row.append(duration) # append duration
-                log_id = str(uuid.uuid4())
-                print('.')
-                cursor.execute(rf"""INSERT INTO public.etl_1(
-                                id, date, time, server_ip, 
-                                method, uri_stem, uri_query, 
-                                server_port, username, client_ip, 
-                                client_browser, client_cookie, 
-                                client_referrer, status, 
-                                substatus, win32_status, 
-                                bytes_sent, bytes_received, 
-                                duration, in_etl_2) VALUES (%s, %s, %s, %s, %s, %s, 
-                                %s, %s, %s, %s, %s, %s, %s, %s, %s, 
-                                %s, %s, %s, %s, %s)""", (log_id, new_row[0],
-                                new_row[1], new_row[2], new_row[3], new_row[4], new_row[5], 
-                                new_row[6], new_row[7], new_row[8], new_row[9], new_row[10], 
-                                new_row[11], new_row[12], new_row[13], new_row[14], new_row[15],
-                                new_row[16], new_row[17], in_etl_2_flag))
-                print('.')
-            elif len(single_log) == 15:
-                new_row = []
-                new_row.append(single_log[0]) # append date
-                new_timestamp = single_log[0:2]
-                new_timestamp = " ".join(new_timestamp)
-                new_row.append(new_timestamp) # append timestamp
-                new_row.append(single_log[2]) # append server_ip
-                new_row.append(single_log[3]) # append method
-                new_row.append(single_log[4]) # append uri_stem
-                new_row.append(single_log[5]) # append uri_query
-                server_port = int(single_log[6])
-                new_row.append(server_port) # append server_port
-                new_row.append(single_log[7]) # append username
-                new_row.append(single_log[8]) # append client_ip
-                new_row.append(single_log[9]) # append client_browser
-                status = int(single_log[10])
-                new_row.append(status) # append status
-                sub_status = int(single_log[11])
-                new_row.append(sub_status) # append sub_status
-                win32_status = int(single_log[12])
-                new_row.append(win32_status) # append win32_status
-                duration = int(single_log[13])
-                new_row.append(duration) # append duration
-                new_row.append('') # to replace client_cookie NULL with empty string
-                log_id = str(uuid.uuid4())
-                print('.')
-                cursor.execute(rf"""INSERT INTO public.etl_1(
-                                id, date, time, server_ip, 
-                                method, uri_stem, uri_query, 
-                                server_port, username, client_ip, 
-                                client_browser, status, 
-                                substatus, win32_status,  
-                                duration, client_cookie, in_etl_2) VALUES (%s, %s, %s, %s, %s, %s, 
-                                %s, %s, %s, %s, %s, %s, %s, %s, %s, 
-                                %s)""", (log_id, new_row[0],
-                                new_row[1], new_row[2], new_row[3], new_row[4], new_row[5], 
-                                new_row[6], new_row[7], new_row[8], new_row[9], new_row[10], 
-                                new_row[11], new_row[12], new_row[13], new_row[14], in_etl_2_flag))
-                print('.')
-            else:
-                print('not 18 columns long')
-
-        cursor.execute(rf"""UPDATE public.s3_load SET in_etl_1=True
-                            WHERE in_etl_1=False""")
+            for row in etl_1_rows(cursor, [single_log], caches):
+                cursor.execute(rf"""INSERT INTO public.etl_1({', '.join(ETL_1_COLUMNS)})
+                                VALUES ({', '.join(['%s'] * len(ETL_1_COLUMNS))})""", row)
+            etl_stage.add(rows=1)
 
+        set_watermark(cursor, 'etl_1', batches[1])
 
-if __name__ == '__main__':
+@timed('etl_1')
+def insert_into_table_batched(batch_size=etl_batch_size):
+    with UseRedshift(redshift_db_config) as cursor:
+        batches = new_batches(cursor)
+        if batches is None:
+            return
+        caches    = load_dimension_caches(cursor) if key_mode == 'cache' else None
+        etl_stage = etl_1_stage(cursor, batches)
+
+        # Named cursor: rows are fetched from the server batch by batch
+        # instead of pulling the whole backlog into memory with fetchall()
+        source = cursor.connection.cursor(name='s3_load_to_etl_1')
+        source.itersize = batch_size
+        source.execute(SELECT_S3_LOAD, batches)
+        while True:
+            logs = source.fetchmany(batch_size)
+            if not logs:
+                break
+            rows = etl_1_rows(cursor, logs, caches)
+            insert_values(cursor, 'public.etl_1', ETL_1_COLUMNS, rows,
+                          page_size=batch_size)
+            etl_stage.add(rows=len(logs))
+        source.close()
+
+        set_watermark(cursor, 'etl_1', batches[1])
+
+@timed('etl_1')
+def insert_into_table_sql():
+    with UseRedshift(redshift_db_config) as cursor:
+        batches = new_batches(cursor)
+        if batches is None:
+            return
+        # Same transformation as to_etl_1_row, done set-based in the cluster.
+        # 14-field rows already hold NULLs for the columns they don't have
+        etl_stage    = stage('etl_1')
+        fact_key_sql = ''.join(f""",
+                                {dimension_key_sql(dimension, 'typed')}"""
+                               for dimension in FACT_KEY_COLUMNS
+                               if key_mode == 'hash')
+        crawler_filter = (f"""
+                                    AND NOT {crawler_sql('s3_load.client_browser')}"""
+                          if skip_crawlers else '')
+        cursor.execute(rf"""INSERT INTO public.etl_1({', '.join(ETL_1_COLUMNS)})
+                            SELECT MD5(RANDOM()::VARCHAR || CAST(typed.time AS VARCHAR) 
+                                    || COALESCE(typed.client_ip, '')),
+                                {', '.join(f'typed.{column}' for column in LOG_COLUMNS)},
+                                typed.load_batch_id{fact_key_sql}
+                            FROM (SELECT CAST(s3_load.date AS DATE) AS date,
+                                    CAST(s3_load.date || ' ' || s3_load.time AS TIMESTAMP) AS time,
+                                    s3_load.server_ip,
+                                    s3_load.method,
+                                    s3_load.uri_stem,
+                                    s3_load.uri_query,
+                                    CAST(NULLIF(s3_load.server_port, '-') AS INT) AS server_port,
+                                    s3_load.username,
+                                    s3_load.client_ip,
+                                    s3_load.client_browser,
+                                    COALESCE(s3_load.client_cookie, '') AS client_cookie,
+                                    s3_load.client_referrer,
+                                    CAST(NULLIF(s3_load.status, '-') AS INT) AS status,
+                                    CAST(NULLIF(s3_load.substatus, '-') AS INT) AS substatus,
+                                    CAST(NULLIF(s3_load.win32_status, '-') AS INT) AS win32_status,
+                                    CAST(NULLIF(s3_load.bytes_sent, '-') AS INT) AS bytes_sent,
+                                    CAST(NULLIF(s3_load.bytes_received, '-') AS INT) AS bytes_received,
+                                    CAST(NULLIF(s3_load.duration, '-') AS INT) AS duration,
+                                    s3_load.load_batch_id
+                                FROM public.s3_load s3_load
+                                WHERE s3_load.load_batch_id > %s
+                                    AND s3_load.load_batch_id <= %s{crawler_filter}) typed""", batches)
+        etl_stage.add(rows=cursor.rowcount)
+
+        # Same transaction as the INSERT, so the watermark only moves if it commits
+        set_watermark(cursor, 'etl_1', batches[1])
+
+def main():
     create_table()
-    insert_into_table()
+    if etl_mode == 'sql':
+        insert_into_table_sql()
+    elif etl_mode == 'batched':
+        insert_into_table_batched()
+    else:
+        insert_into_table()
+
+if etl_mode == 'sql' and key_mode == 'cache':
+    print('[INFO]: KEY_MODE=cache needs ETL_1_MODE=batched or insert')
+    sys.exit(1)
 
+
+if __name__ == '__main__':
+    main()
+    print('-------- Connection pool: ', pool_stats(redshift_db_config), ' --------')
+    write_summary(pool=pool_stats(redshift_db_config))
+    report_trace()
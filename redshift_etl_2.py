@@ -1,13 +1,20 @@
 #! usr/bin/python3
 
 import os
-import re
 import sys
 import uuid
-import requests
 import psycopg2
 import boto3
-from redshift_connect import UseRedshift
+from redshift_connect import UseRedshift, pool_stats
+from geo_lookup import shared_resolver
+from dimensions import (dimension_key, dimension_row, dimension_match_sql, key_sql,
+                        DIMENSION_COLUMNS, DIMENSION_KEYS, KEY_SENTINELS)
+from calendar_dims import date_rows, time_rows, SECONDS_PER_DAY
+from bulk_load import upsert_rows
+from pipeline_state import (create_state_table, add_column, check_columns, pending_batches,
+                            set_watermark)
+from metrics import stage, timed, write_summary
+from sql_trace import report_trace
 
 aws_access_key = os.environ.get('AWS_ACCESS_KEY')
 aws_secret_key = os.environ.get('AWS_SECRET_KEY')
@@ -17,6 +24,25 @@ redshift_pw    = os.environ.get('REDSHIFT_PW')
 redshift_endpt = os.environ.get('REDSHIFT_ENDPT')
 redshift_port  = os.environ.get('REDSHIFT_PORT')
 
+# Locations are cached on disk for CACHE_TTL, so repeat runs only look up
+# IPs that haven't been seen; GEO_LOOKUP_URL can point at a local stub
+geo_lookup_url   = os.environ.get('GEO_LOOKUP_URL', 'https://ipinfo.io')
+geo_lookup_token = os.environ.get('IPINFO_TOKEN')
+geo_cache_path   = os.environ.get('GEO_CACHE_PATH', 'geo_cache.sqlite')
+geo_workers      = int(os.environ.get('GEO_WORKERS', 8))
+geo_rate         = float(os.environ.get('GEO_RATE', 10)) # requests per second
+# With GEO_INDEX_PATH / GEO_CSV set, locations come from the offline index
+# instead (built from the CSV and saved on first use)
+geo_index_path   = os.environ.get('GEO_INDEX_PATH')
+geo_csv_path     = os.environ.get('GEO_CSV')
+
+# With KEY_MODE=hash dimension ids are hashes of their natural keys, the
+# same ones redshift_etl_1 writes into etl_1, so no join-back is needed.
+# With KEY_MODE=cache redshift_etl_1 has already keyed the fact rows and
+# written new dimension members, so only the flags are left to update, and
+# the locations of IPs whose geo lookup failed there (CACHE_MODE_DIMENSIONS)
+key_mode         = os.environ.get('KEY_MODE', 'uuid')
+
 if all(x in os.environ for x in ['AWS_ACCESS_KEY', 'AWS_SECRET_KEY', 
                                 'DB_NAME', 'REDSHIFT_USER', 
                                 'REDSHIFT_PW', 'REDSHIFT_ENDPT',
@@ -42,6 +68,11 @@ redshift_db_config = {'dbname': db_name,
                     'user': redshift_user,
                     'password': redshift_pw}
 
+def new_dimension_id(*natural_key) -> str:
+    if key_mode == 'hash':
+        return dimension_key(*natural_key)
+    return str(uuid.uuid4())
+
 def create_table():
     with UseRedshift(redshift_db_config) as cursor:
         SQL_CREATE_DATE = rf"""CREATE TABLE IF NOT EXISTS public.dim_date (
@@ -54,7 +85,7 @@ def create_table():
                     year INTEGER)"""
         SQL_CREATE_TIME = rf"""CREATE TABLE IF NOT EXISTS public.dim_time (
                     id VARCHAR(50), 
-                    time TIMESTAMP, 
+                    second_of_day INTEGER, 
                     hour INTEGER, 
                     minute INTEGER, 
                     second INTEGER)"""
@@ -68,10 +99,9 @@ def create_table():
         SQL_CREATE_REQUEST = rf"""CREATE TABLE IF NOT EXISTS public.dim_request (
                     id VARCHAR(50), 
                     method VARCHAR(10), 
-                    client_browser VARCHAR(1000), 
                     client_referrer VARCHAR(1000), 
                     status INTEGER, 
-                    duration INTEGER)"""
+                    duration_bucket VARCHAR(20))"""
         SQL_CREATE_FILE = rf"""CREATE TABLE IF NOT EXISTS public.dim_file (
                     id VARCHAR(50), 
                     uri_stem VARCHAR(80), 
@@ -81,6 +111,13 @@ def create_table():
         SQL_CREATE_VISIT = rf"""CREATE TABLE IF NOT EXISTS public.dim_visit (
                     id VARCHAR(50), 
                     client_cookie VARCHAR(1000))"""
+        SQL_CREATE_USER_AGENT = rf"""CREATE TABLE IF NOT EXISTS public.dim_user_agent (
+                    id VARCHAR(50), 
+                    client_browser VARCHAR(1000), 
+                    browser VARCHAR(50), 
+                    os VARCHAR(50), 
+                    device_type VARCHAR(20), 
+                    is_crawler BOOLEAN)"""
         try:
             print('-------- Executing CREATE TABLE --------')
             cursor.execute(SQL_CREATE_DATE)
@@ -89,194 +126,128 @@ def create_table():
             cursor.execute(SQL_CREATE_REQUEST)
             cursor.execute(SQL_CREATE_FILE)
             cursor.execute(SQL_CREATE_VISIT)
+            cursor.execute(SQL_CREATE_USER_AGENT)
+            add_column(cursor, 'public.dim_user_agent', 'is_crawler', 'BOOLEAN')
+            create_state_table(cursor)
             print('-------- SQL CREATE Complete --------')
         except Exception as err:
             print('Error executing SQL: ', err)
+        check_columns(cursor)
+
+def upsert_dimension(cursor, dimension: str, rows) -> None:
+    inserted = upsert_rows(cursor, f'public.dim_{dimension}', DIMENSION_COLUMNS[dimension],
+                           DIMENSION_KEYS[dimension], rows, sentinels=KEY_SENTINELS)
+    stage(f'dim_{dimension}').add(rows=inserted)
+    print(f'-------- Inserted {inserted} {dimension.upper()} rows --------')
 
-def insert_into_date():
+@timed('dim_date')
+def insert_into_date(batches):
     with UseRedshift(redshift_db_config) as cursor:
-        cursor.execute(rf"""SELECT DISTINCT etl_1.date 
+        # Fill the whole calendar between the first and last new date,
+        # not just the dates that happen to have traffic
+        cursor.execute(rf"""SELECT MIN(etl_1.date), MAX(etl_1.date)
                             FROM public.etl_1 etl_1
-                            LEFT JOIN public.dim_date dim_date 
-                                ON dim_date.date = etl_1.date
-                            WHERE etl_1.in_etl_2=False
-                                AND dim_date.date IS NULL""")
-        dates = cursor.fetchall()
-        for i, date in zip(range(len(dates)), dates):
-            date_str   = dates[i][0].isoformat()
-            split_date = date_str.split('-')
-            year       = split_date[0]
-            month      = split_date[1]
-            day        = split_date[2]
-            if month in ['01','02','03']:
-                qtr    = '1'
-            elif month in ['04','05','06']:
-                qtr    = '2'
-            elif month in ['07','08','09']:
-                qtr    = '3'
-            else:
-                qtr    = '4'
-            date_id = str(uuid.uuid4())
-            print('-------- Executing INSERT DATE Statement --------')
-            cursor.execute(rf"""INSERT INTO public.dim_date(
-                                id, date, day, month, quarter, year)
-                                VALUES(%s, %s, %s, %s, %s, %s)""", 
-                                (date_id, date, day, month, qtr, year))
-            print('-------- Insert Statement Complete -------- ')
+                            WHERE etl_1.load_batch_id > %s
+                                AND etl_1.load_batch_id <= %s""", batches)
+        first_date, last_date = cursor.fetchone()
+        if first_date is None:
+            return
+        upsert_dimension(cursor, 'date', date_rows(first_date, last_date, new_dimension_id))
 
-def insert_into_time():
+@timed('dim_time')
+def insert_into_time(batches):
     with UseRedshift(redshift_db_config) as cursor:
-        cursor.execute(rf"""SELECT DISTINCT etl_1.time 
-                            FROM public.etl_1 etl_1
-                            LEFT JOIN public.dim_time dim_time 
-                                ON dim_time.time = etl_1.time
-                            WHERE etl_1.in_etl_2=False
-                                AND dim_time.time IS NULL""")
-        times = cursor.fetchall()
-        for i, time in zip(range(len(times)), times):
-            time_str   = times[i][0].isoformat()
-            split_time = time_str.split('T') # returns ['2009-10-24', '01:40:40']
-            hr_min_sec     = []
-            for i in split_time:
-                hr_min_sec = i.split(':') # returns ['01', '40', '40']
-            hour    = hr_min_sec[0]
-            minute  = hr_min_sec[1]
-            second  = hr_min_sec[2]
-            time_id = str(uuid.uuid4())
-            print('-------- Executing INSERT TIME Statement --------')
-            cursor.execute(rf"""INSERT INTO public.dim_time(
-                                id, time, hour, minute, second)
-                                VALUES(%s, %s, %s, %s, %s)""", 
-                                (time_id, time, hour, minute, second))
-            print('-------- Insert Statement Complete -------- ')
+        # dim_time has one row per second of the day, so it only ever needs
+        # filling once, however much traffic there is
+        cursor.execute(rf"""SELECT COUNT(*) FROM public.dim_time""")
+        if cursor.fetchone()[0] >= SECONDS_PER_DAY:
+            return
+        upsert_dimension(cursor, 'time', time_rows(new_dimension_id))
 
-def insert_into_location():
+def resolve_client_ips(client_ips) -> dict:
+    resolve = shared_resolver(geo_index_path, geo_csv_path, geo_cache_path, geo_lookup_url,
+                              geo_lookup_token, workers=geo_workers, rate=geo_rate)
+    return resolve(client_ips)
+
+@timed('dim_location')
+def insert_into_location(batches):
     with UseRedshift(redshift_db_config) as cursor:
+        # Anti-join kept here so known IPs are never sent to the geo lookup.
+        # Not limited to `batches`: IPs whose lookup failed in an earlier run
+        # have no member yet, whether their rows' location_id is still NULL
+        # or, with KEY_MODE=hash, already the hash of the IP
         cursor.execute(rf"""SELECT DISTINCT etl_1.client_ip
                             FROM public.etl_1 etl_1
                             LEFT JOIN public.dim_location dim_location
                                 ON dim_location.client_ip = etl_1.client_ip
-                            WHERE etl_1.in_etl_2=False
+                            WHERE etl_1.client_ip IS NOT NULL
                                 AND dim_location.client_ip IS NULL""")
-        client_ips = cursor.fetchall()
-        for ip in client_ips:
-            results      = requests.get(f'https://ipinfo.io/{ip[0]}')
-            results_dict = results.json()
-            if 'postal' in results_dict.keys():
-                postcode     = results_dict['postal']
-            else:
-                postcode = None
-            if 'city' in results_dict.keys():
-                city         = results_dict['city']
-            else:
-                city     = None
-            if 'region' in results_dict.keys():
-                region       = results_dict['region']
-            else:
-                region   = None
-            country      = results_dict['country']
-            location_id  = str(uuid.uuid4())
-            print('-------- Executing INSERT LOCATION Statement --------')
-            cursor.execute(rf"""INSERT INTO public.dim_location(
-                                id, client_ip, postcode, city, region, country)
-                                VALUES(%s, %s, %s, %s, %s, %s)""", 
-                                (location_id, ip[0], postcode, city, region, country))
-            print('-------- Insert Statement Complete -------- ')
+        client_ips = [ip[0] for ip in cursor.fetchall()]
+        locations  = resolve_client_ips(client_ips)
+        # failed lookups are left out and retried on the next run
+        upsert_dimension(cursor, 'location',
+                         [dimension_row('location', new_dimension_id(ip), (ip,), locations[ip])
+                          for ip in client_ips if ip in locations])
 
-def insert_into_request():
+@timed('dim_request')
+def insert_into_request(batches):
     with UseRedshift(redshift_db_config) as cursor:
         cursor.execute(rf"""SELECT DISTINCT etl_1.method, 
-                                            etl_1.client_browser, 
                                             etl_1.client_referrer, 
                                             etl_1.status, 
-                                            etl_1.duration
+                                            {key_sql('duration_bucket', 'etl_1')}
                             FROM public.etl_1 etl_1
-                            LEFT JOIN public.dim_request dim_request
-                                ON dim_request.method = etl_1.method
-                                AND dim_request.client_browser = etl_1.client_browser
-                                AND dim_request.client_referrer = etl_1.client_referrer
-                                AND dim_request.status = etl_1.status
-                                AND dim_request.duration = etl_1.duration
-                            WHERE etl_1.in_etl_2=False
-                                AND dim_request.method IS NULL
-                                AND dim_request.client_browser IS NULL
-                                AND dim_request.client_referrer IS NULL
-                                AND dim_request.status IS NULL
-                                AND dim_request.duration IS NULL""")
-        request_results = cursor.fetchall()
-        for i in request_results:
-            method          = i[0]
-            client_browser  = i[1]
-            client_referrer = i[2]
-            status          = i[3]
-            duration        = i[4]
-            request_id      = str(uuid.uuid4())
-            print('-------- Executing INSERT REQUEST Statement --------')
-            cursor.execute(rf"""INSERT INTO public.dim_request(
-                                id, method, client_browser, client_referrer, status, duration)
-                                VALUES(%s, %s, %s, %s, %s, %s)""", 
-                                (request_id, method, client_browser, client_referrer, status, duration))
-            print('-------- Insert Statement Complete -------- ')
+                            WHERE etl_1.load_batch_id > %s
+                                AND etl_1.load_batch_id <= %s""", batches)
+        upsert_dimension(cursor, 'request',
+                         [dimension_row('request', new_dimension_id(*key), key)
+                          for key in cursor.fetchall()])
 
-def insert_into_file():
+@timed('dim_file')
+def insert_into_file(batches):
     with UseRedshift(redshift_db_config) as cursor:
         cursor.execute(rf"""SELECT DISTINCT etl_1.uri_stem, 
                                             etl_1.bytes_sent
                             FROM public.etl_1 etl_1
-                            LEFT JOIN public.dim_file dim_file
-                                ON dim_file.uri_stem = etl_1.uri_stem
-                                AND dim_file.bytes_sent = etl_1.bytes_sent
-                            WHERE etl_1.in_etl_2=False
-                                AND dim_file.uri_stem IS NULL
-                                AND dim_file.bytes_sent IS NULL""")
-
-        file_contents = cursor.fetchall()
-        for i in file_contents:
-            uri_stem   = i[0]
-            bytes_sent = i[1]
-            file_ext  = re.search(r'\.[A-Za-z0-9]+$', i[0])
-            if file_ext is not None:
-                file_type = file_ext.group(0)
-            else:
-                file_type = file_ext
-            if uri_stem == '/robots.txt':
-                is_crawler = True
-            else:
-                is_crawler = False
-            file_id    = str(uuid.uuid4())
-            print('-------- Executing INSERT FILE Statement --------')
-            cursor.execute(rf"""INSERT INTO public.dim_file(
-                                id, uri_stem, bytes_sent, file_type, is_crawler)
-                                VALUES(%s, %s, %s, %s, %s)""", 
-                                (file_id, uri_stem, bytes_sent, file_type, is_crawler))
-            print('-------- Insert Statement Complete -------- ')
+                            WHERE etl_1.load_batch_id > %s
+                                AND etl_1.load_batch_id <= %s""", batches)
+        upsert_dimension(cursor, 'file',
+                         [dimension_row('file', new_dimension_id(*key), key)
+                          for key in cursor.fetchall()])
 
-def insert_into_visit():
+@timed('dim_visit')
+def insert_into_visit(batches):
     with UseRedshift(redshift_db_config) as cursor:
-        cursor.execute(rf"""SELECT DISTINCT etl_1.client_cookie
+        cursor.execute(rf"""SELECT DISTINCT COALESCE(etl_1.client_cookie, '')
                             FROM public.etl_1 etl_1
-                            LEFT JOIN public.dim_visit dim_visit
-                                ON dim_visit.client_cookie = etl_1.client_cookie
-                            WHERE etl_1.in_etl_2=False
-                                AND dim_visit.client_cookie IS NULL""")
+                            WHERE etl_1.load_batch_id > %s
+                                AND etl_1.load_batch_id <= %s""", batches)
+        upsert_dimension(cursor, 'visit',
+                         [dimension_row('visit', new_dimension_id(*key), key)
+                          for key in cursor.fetchall()])
 
-        cookies = cursor.fetchall()
-        for i in cookies:
-            if i[0] == None:
-                client_cookie = ''
-            else:
-                client_cookie  = i[0]
-            visit_id       = str(uuid.uuid4())
-            print('-------- Executing INSERT VISIT Statement --------')
-            cursor.execute(rf"""INSERT INTO public.dim_visit(
-                                id, client_cookie)
-                                VALUES(%s, %s)""", 
-                                (visit_id, client_cookie))
-            print('-------- Insert Statement Complete -------- ')
+@timed('dim_user_agent')
+def insert_into_user_agent(batches):
+    with UseRedshift(redshift_db_config) as cursor:
+        # browser / os / device and is_crawler come from a memoized parse of
+        # each distinct string
+        cursor.execute(rf"""SELECT DISTINCT etl_1.client_browser
+                            FROM public.etl_1 etl_1
+                            WHERE etl_1.load_batch_id > %s
+                                AND etl_1.load_batch_id <= %s""", batches)
+        upsert_dimension(cursor, 'user_agent',
+                         [dimension_row('user_agent', new_dimension_id(*key), key)
+                          for key in cursor.fetchall()])
 
 
-def insert_ids_to_fact():
+@timed('fact_keys')
+def insert_ids_to_fact(batches, dimensions=None):
+    # Not limited to `batches`: rows of earlier batches still missing a key
+    # (e.g. after a failed geo lookup) are keyed once the member exists.
+    # Any failure propagates, so mark_processed doesn't move the watermark.
+    # `dimensions` limits the keys set, all of them by default
     with UseRedshift(redshift_db_config) as cursor:
+        fact_stage = stage('fact_keys')
         INSERT_DATE_ID = rf"""UPDATE public.etl_1
                             SET date_id = public.dim_date.id
                             FROM public.dim_date
@@ -285,7 +256,7 @@ def insert_ids_to_fact():
         INSERT_TIME_ID = rf"""UPDATE public.etl_1
                             SET time_id = public.dim_time.id
                             FROM public.dim_time
-                                WHERE public.etl_1.time = public.dim_time.time
+                                WHERE {key_sql('second_of_day', 'public.etl_1')} = public.dim_time.second_of_day
                                 AND public.etl_1.time_id IS NULL;"""
         INSERT_LOCATION_ID = rf"""UPDATE public.etl_1
                                 SET location_id = public.dim_location.id
@@ -295,50 +266,75 @@ def insert_ids_to_fact():
         INSERT_REQUEST_ID = rf"""UPDATE public.etl_1
                                 SET request_id = public.dim_request.id
                                 FROM public.dim_request
-                                    WHERE public.etl_1.method        = public.dim_request.method
-                                    AND public.etl_1.client_browser  = public.dim_request.client_browser
-                                    AND (public.etl_1.client_referrer = public.dim_request.client_referrer 
-                                        OR (public.etl_1.client_referrer IS NULL
-                                            AND public.dim_request.client_referrer IS NULL))
-                                    AND public.etl_1.status          = public.dim_request.status
-                                    AND public.etl_1.duration        = public.dim_request.duration
+                                    WHERE {dimension_match_sql('request', 'public.etl_1', 'public.dim_request')}
                                     AND public.etl_1.request_id IS NULL;"""
-                                    # fixed by accepting NULLs for client_referrer
-
         INSERT_FILE_ID = rf"""UPDATE public.etl_1
                             SET file_id = public.dim_file.id
                             FROM public.dim_file
-                            WHERE public.etl_1.uri_stem = public.dim_file.uri_stem
-                                AND (public.etl_1.bytes_sent = public.dim_file.bytes_sent
-                                        OR (public.etl_1.bytes_sent IS NULL 
-                                            AND public.dim_file.bytes_sent IS NULL))
+                            WHERE {dimension_match_sql('file', 'public.etl_1', 'public.dim_file')}
                                 AND public.etl_1.file_id IS NULL;"""
-                                # fixed by accepting NULLs for bytes_sent
         INSERT_VISIT_ID = rf"""UPDATE public.etl_1
                             SET visit_id = public.dim_visit.id
                             FROM public.dim_visit
                             WHERE public.etl_1.client_cookie = public.dim_visit.client_cookie
                                 AND public.etl_1.visit_id IS NULL;"""
-        try:
-            cursor.execute(INSERT_DATE_ID)
-            cursor.execute(INSERT_TIME_ID)
-            cursor.execute(INSERT_LOCATION_ID)
-            cursor.execute(INSERT_REQUEST_ID)
-            cursor.execute(INSERT_FILE_ID)
-            cursor.execute(INSERT_VISIT_ID)
-        except Exception as err:
-            print('Error: ', err)
+        INSERT_USER_AGENT_ID = rf"""UPDATE public.etl_1
+                            SET user_agent_id = public.dim_user_agent.id
+                            FROM public.dim_user_agent
+                            WHERE {dimension_match_sql('user_agent', 'public.etl_1', 'public.dim_user_agent')}
+                                AND public.etl_1.user_agent_id IS NULL;"""
+        updates = {'date':       INSERT_DATE_ID,
+                   'time':       INSERT_TIME_ID,
+                   'location':   INSERT_LOCATION_ID,
+                   'request':    INSERT_REQUEST_ID,
+                   'file':       INSERT_FILE_ID,
+                   'visit':      INSERT_VISIT_ID,
+                   'user_agent': INSERT_USER_AGENT_ID}
+        for dimension in dimensions or updates:
+            cursor.execute(updates[dimension])
+            fact_stage.add(rows=cursor.rowcount)
+
+# Independent of each other: each only reads etl_1 and writes its own table
+DIMENSION_LOADERS = {'date':       insert_into_date,
+                     'time':       insert_into_time,
+                     'location':   insert_into_location,
+                     'request':    insert_into_request,
+                     'file':       insert_into_file,
+                     'visit':      insert_into_visit,
+                     'user_agent': insert_into_user_agent}
+# Built (and keyed) here even with KEY_MODE=cache
+CACHE_MODE_DIMENSIONS = ('location',)
 
-        cursor.execute(rf"""UPDATE public.etl_1 SET in_etl_2=True
-                            WHERE in_etl_2=False""")
+def dimensions_to_build() -> tuple:
+    return CACHE_MODE_DIMENSIONS if key_mode == 'cache' else tuple(DIMENSION_LOADERS)
+
+def key_facts(batches):
+    # KEY_MODE=hash rows are keyed by redshift_etl_1 already
+    if key_mode == 'uuid':
+        insert_ids_to_fact(batches)
+    elif key_mode == 'cache':
+        insert_ids_to_fact(batches, CACHE_MODE_DIMENSIONS)
+
+def new_batches():
+    # etl_1 load batches that arrived since this stage's last watermark
+    with UseRedshift(redshift_db_config) as cursor:
+        return pending_batches(cursor, 'etl_2', 'public.etl_1')
+
+def mark_processed(batches):
+    with UseRedshift(redshift_db_config) as cursor:
+        set_watermark(cursor, 'etl_2', batches[1])
 
 
 if __name__ == '__main__':
     create_table()
-    insert_into_date()
-    insert_into_time()
-    insert_into_location()
-    insert_into_request()
-    insert_into_file()
-    insert_into_visit()
-    insert_ids_to_fact()
+    batches = new_batches()
+    if batches is None:
+        print('-------- No new load batches --------')
+        sys.exit(0)
+    for dimension in dimensions_to_build():
+        DIMENSION_LOADERS[dimension](batches)
+    key_facts(batches)
+    mark_processed(batches)
+    print('-------- Connection pool: ', pool_stats(redshift_db_config), ' --------')
+    write_summary(pool=pool_stats(redshift_db_config))
+    report_trace()
\ No newline at end of file
@@ -0,0 +1,132 @@
+#! /usr/bin/env python3
+
+######## Hourly and daily rollups of public.etl_1 for the dashboards ########
+######## Each run merges only the load batches redshift_etl_2 has keyed since ########
+######## the last run into the affected buckets; --rebuild starts over. ########
+
+import sys
+import argparse
+from redshift_connect import UseRedshift, pool_stats
+from bulk_load import null_safe_equals
+from pipeline_state import create_state_table, get_watermark, set_watermark
+from metrics import stage, timed, write_summary
+from sql_trace import report_trace
+from redshift_etl_2 import redshift_db_config
+
+ROLLUP_KEYS     = ('uri_stem', 'country')
+# Sums and counts only, so merging a batch is plain addition. Average
+# duration is duration_sum / duration_count
+ROLLUP_MEASURES = ('hits', 'bytes_sent', 'duration_sum', 'duration_count',
+                   'status_2xx', 'status_3xx', 'status_4xx', 'status_5xx')
+# table -> (time bucket column, its type, temp table of a run's new rows).
+# The hourly delta is aggregated from etl_1, the daily one from the hourly
+ROLLUPS         = {'public.rollup_hourly': ('hour', 'TIMESTAMP', 'rollup_delta_hourly'),
+                   'public.rollup_daily':  ('day', 'DATE', 'rollup_delta_daily')}
+
+def create_table():
+    with UseRedshift(redshift_db_config) as cursor:
+        try:
+            print('-------- Executing CREATE TABLE --------')
+            for table, (bucket, bucket_type, _) in ROLLUPS.items():
+                cursor.execute(rf"""CREATE TABLE IF NOT EXISTS {table} (
+                                    {bucket} {bucket_type},
+                                    uri_stem VARCHAR(80),
+                                    country VARCHAR(200),
+                                    {', '.join(f'{measure} BIGINT' for measure in ROLLUP_MEASURES)})""")
+            create_state_table(cursor)
+            print('-------- SQL CREATE Complete --------')
+        except Exception as err:
+            print('Error executing SQL: ', err)
+
+def status_count(low: int) -> str:
+    return f'SUM(CASE WHEN etl_1.status BETWEEN {low} AND {low + 99} THEN 1 ELSE 0 END)'
+
+SQL_HOURLY_DELTA = rf"""CREATE TEMP TABLE rollup_delta_hourly AS
+                        SELECT DATE_TRUNC('hour', etl_1.time) AS hour,
+                            etl_1.uri_stem,
+                            dim_location.country,
+                            COUNT(*) AS hits,
+                            COALESCE(SUM(etl_1.bytes_sent), 0) AS bytes_sent,
+                            COALESCE(SUM(etl_1.duration), 0) AS duration_sum,
+                            COUNT(etl_1.duration) AS duration_count,
+                            {status_count(200)} AS status_2xx,
+                            {status_count(300)} AS status_3xx,
+                            {status_count(400)} AS status_4xx,
+                            {status_count(500)} AS status_5xx
+                        FROM public.etl_1 etl_1
+                        LEFT JOIN public.dim_location dim_location
+                            ON dim_location.id = etl_1.location_id
+                        WHERE etl_1.load_batch_id > %s
+                            AND etl_1.load_batch_id <= %s
+                            AND etl_1.time IS NOT NULL
+                        GROUP BY 1, 2, 3"""
+
+SQL_DAILY_DELTA = rf"""CREATE TEMP TABLE rollup_delta_daily AS
+                        SELECT CAST(DATE_TRUNC('day', delta.hour) AS DATE) AS day,
+                            delta.uri_stem,
+                            delta.country,
+                            {', '.join(f'SUM(delta.{measure}) AS {measure}'
+                                       for measure in ROLLUP_MEASURES)}
+                        FROM rollup_delta_hourly delta
+                        GROUP BY 1, 2, 3"""
+
+def merge_delta(cursor, table: str) -> int:
+    # Buckets already in the table are added to, the rest are inserted.
+    # Keys are compared NULL-safe: country is NULL for unlocated IPs
+    bucket, _, delta = ROLLUPS[table]
+    columns = (bucket, *ROLLUP_KEYS, *ROLLUP_MEASURES)
+    cursor.execute(rf"""UPDATE {table}
+                        SET {', '.join(f'{measure} = {table}.{measure} + delta.{measure}'
+                                       for measure in ROLLUP_MEASURES)}
+                        FROM {delta} delta
+                        WHERE {table}.{bucket} = delta.{bucket}
+                            AND {null_safe_equals(ROLLUP_KEYS, table, 'delta')}""")
+    updated = cursor.rowcount
+    cursor.execute(rf"""INSERT INTO {table} ({', '.join(columns)})
+                        SELECT {', '.join(f'delta.{column}' for column in columns)}
+                        FROM {delta} delta
+                        WHERE NOT EXISTS (SELECT 1 FROM {table} existing
+                                          WHERE existing.{bucket} = delta.{bucket}
+                                            AND {null_safe_equals(ROLLUP_KEYS, 'existing', 'delta')})""")
+    return updated + cursor.rowcount
+
+@timed('rollups')
+def merge_new_batches(rebuild: bool = False):
+    # Everything from the rollup watermark up to what etl_2 has keyed, in
+    # one transaction with the watermark, so no batch is counted twice
+    with UseRedshift(redshift_db_config) as cursor:
+        # Serialises concurrent runs before the watermark is read
+        cursor.execute(rf"""LOCK public.rollup_hourly""")
+        if rebuild:
+            for table in ROLLUPS:
+                cursor.execute(rf"""DELETE FROM {table}""")
+            set_watermark(cursor, 'rollup', 0)
+        batches = get_watermark(cursor, 'rollup'), get_watermark(cursor, 'etl_2')
+        if batches[0] >= batches[1]:
+            print('-------- No new batches to roll up --------')
+            return
+        rollup_stage = stage('rollups')
+        cursor.execute(SQL_HOURLY_DELTA, batches)
+        cursor.execute(SQL_DAILY_DELTA)
+        for table in ROLLUPS:
+            merged = merge_delta(cursor, table)
+            rollup_stage.add(rows=merged)
+            print(f'-------- Merged {merged} {table} buckets --------')
+        # Only on success: after an error the rollback removes the deltas
+        for _, _, delta in ROLLUPS.values():
+            cursor.execute(rf"""DROP TABLE {delta}""")
+        set_watermark(cursor, 'rollup', batches[1])
+
+def main(rebuild: bool = False):
+    create_table()
+    merge_new_batches(rebuild)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Merge new load batches into the rollup tables')
+    parser.add_argument('--rebuild', action='store_true',
+                        help='empty the rollups and rebuild them from every keyed batch')
+    main(parser.parse_args(sys.argv[1:]).rebuild)
+    print('-------- Connection pool: ', pool_stats(redshift_db_config), ' --------')
+    write_summary(pool=pool_stats(redshift_db_config))
+    report_trace()
@@ -4,7 +4,19 @@ import os
 import sys
 import psycopg2
 import boto3
-from redshift_connect import UseRedshift
+from datetime import datetime
+from itertools import chain
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from redshift_connect import UseRedshift, pool_stats
+from bulk_load import copy_rows
+from log_stream import iter_lines, compression_for, detect_compression, MAGIC_LENGTH
+from log_parser import LogParser, LOG_COLUMNS, to_etl_1_row
+from parquet_export import export_and_load
+from user_agent import is_crawler
+from parallel_parse import S3Source, parse_source
+from pipeline_state import create_state_table, add_column, next_batch_id, release_batch
+from metrics import stage, timed, write_summary
+from sql_trace import report_trace
 
 aws_access_key = os.environ.get('AWS_ACCESS_KEY')
 aws_secret_key = os.environ.get('AWS_SECRET_KEY')
@@ -14,6 +26,35 @@ redshift_pw    = os.environ.get('REDSHIFT_PW')
 redshift_endpt = os.environ.get('REDSHIFT_ENDPT')
 redshift_port  = os.environ.get('REDSHIFT_PORT')
 
+# 'insert' loads row by row, 'copy' bulk loads compressed batches.
+# COPY on Redshift stages batches in S3 and needs REDSHIFT_IAM_ROLE;
+# without it batches are streamed with COPY FROM STDIN (local Postgres)
+load_mode         = os.environ.get('LOAD_MODE', 'insert')
+load_batch_size   = int(os.environ.get('LOAD_BATCH_SIZE', 100000))
+redshift_iam_role = os.environ.get('REDSHIFT_IAM_ROLE')
+staging_bucket    = os.environ.get('STAGING_BUCKET', 'la-ticket-bucket-eu')
+staging_prefix    = os.environ.get('STAGING_PREFIX', 'staging/')
+# 'parquet' casts the records while parsing and writes them straight to
+# public.etl_1 through Parquet files partitioned by log date, staged under
+# PARQUET_PREFIX in STAGING_BUCKET (and/or PARQUET_DIR locally); the etl_1
+# stage then has nothing left to do. Needs pyarrow
+parquet_prefix    = os.environ.get('PARQUET_PREFIX', 'parquet/')
+parquet_dir       = os.environ.get('PARQUET_DIR')
+key_mode          = os.environ.get('KEY_MODE', 'uuid')
+# As in redshift_etl_1: with SKIP_CRAWLERS=1 parquet mode leaves bot
+# requests out of etl_1 (the other modes keep them in s3_load)
+skip_crawlers     = os.environ.get('SKIP_CRAWLERS', '0') not in ('', '0')
+
+# Without LOG_KEY every object under the log prefix that isn't in
+# public.s3_load_manifest yet is loaded, INGEST_WORKERS objects at a time
+log_bucket     = os.environ.get('LOG_BUCKET', 'la-ticket-bucket-eu')
+log_prefix     = os.environ.get('LOG_PREFIX', 'BI_logs/')
+log_key        = os.environ.get('LOG_KEY')
+ingest_workers = int(os.environ.get('INGEST_WORKERS', 4))
+# PARSE_WORKERS > 1 splits each uncompressed object into newline-aligned
+# byte ranges and parses them in that many processes
+parse_workers  = int(os.environ.get('PARSE_WORKERS', 1))
+
 if all(x in os.environ for x in ['AWS_ACCESS_KEY', 'AWS_SECRET_KEY', 
                                 'DB_NAME', 'REDSHIFT_USER', 
                                 'REDSHIFT_PW', 'REDSHIFT_ENDPT',
@@ -33,6 +74,10 @@ else:
                     """)
     sys.exit(1)
 
+if load_mode == 'parquet' and key_mode == 'cache':
+    print('[INFO]: KEY_MODE=cache needs LOAD_MODE=insert or copy')
+    sys.exit(1)
+
 redshift_db_config = {'dbname': db_name,
                     'host': redshift_endpt,
                     'port': redshift_port,
@@ -60,86 +105,207 @@ def create_table():
                     bytes_sent VARCHAR(100), 
                     bytes_received VARCHAR(100), 
                     duration VARCHAR(100), 
-                    in_etl_1 BOOLEAN)
+                    in_etl_1 BOOLEAN, 
+                    load_batch_id BIGINT)
                     """ 
         try:
             print('-------- Executing CREATE TABLE --------')
             cursor.execute(SQL_CREATE)
+            add_column(cursor, 'public.s3_load', 'load_batch_id', 'BIGINT')
+            create_state_table(cursor)
             print('-------- SQL CREATE Complete --------')
         except Exception as err:
             print('Error executing SQL: ', err)
 
-def insert_into_table():
+# Rows are tagged with the load batch (one per S3 object) they arrived in;
+# later stages process batches past their watermark in public.pipeline_state
+S3_LOAD_COLUMNS = (*LOG_COLUMNS, 'load_batch_id')
+
+def parse_logs(lines, counts: dict = None):
+    # Records come back in s3_load column order whatever the #Fields: layout.
+    # Malformed lines are added to counts['rejected'], if counts is given
+    parser = LogParser()
+    yield from parser.parse(lines)
+    if counts is not None:
+        counts['rejected'] = counts.get('rejected', 0) + parser.rejected
+
+def insert_logs(cursor, logs, load_batch_id: int) -> int:
+    row_count = 0
+
+    for log in logs:
+        cursor.execute(rf"""INSERT INTO public.s3_load(
+                        date, time, server_ip, 
+                        method, uri_stem, uri_query, 
+                        server_port, username, client_ip, 
+                        client_browser, client_cookie, 
+                        client_referrer, status, 
+                        substatus, win32_status, 
+                        bytes_sent, bytes_received, 
+                        duration, load_batch_id) VALUES (%s, %s, %s, %s, %s, 
+                        %s, %s, %s, %s, %s, %s, %s, %s, %s, 
+                        %s, %s, %s, %s, %s)""", (*log, load_batch_id))
+        row_count += 1
+    return row_count
+
+def copy_logs(cursor, logs, load_batch_id: int, s3_client=None) -> int:
+    # Bulk load: one COPY per batch instead of one INSERT per line
+    rows = ((*log, load_batch_id) for log in logs)
+    return copy_rows(cursor, 'public.s3_load', S3_LOAD_COLUMNS, rows,
+                     batch_size=load_batch_size, s3_client=s3_client,
+                     bucket=staging_bucket, prefix=staging_prefix,
+                     iam_role=redshift_iam_role)
+
+def create_manifest_table():
     with UseRedshift(redshift_db_config) as cursor:
-        s3_client = boto3.client('s3',
-            aws_access_key_id=aws_access_key,
-            aws_secret_access_key=aws_secret_key)
-
-        ######## CODE TO ITERATE THROUGH ALL FILES IN S3 BUCKET ########
-        # bucket_contents = s3_client.list_objects(Bucket='la-ticket-bucket-eu', Prefix='BI_logs/')
-        # file_names = []
-        # for i in bucket_contents['Contents']:
-        #     file_names.append(i['Key'])
-        # file_names.pop(0) # remove 'BI_logs' folder name from list, because it's not a specific file name
-        # for log in file_names:
-        ######## If too many files in S3 bucket, the script freezes after a few hours of running ########
-        ######## Instead of iterating through the whole bucket, I process one file each ########
-
-        file_object = s3_client.get_object(Bucket='la-ticket-bucket-eu', 
-                                        Key='BI_logs/u_ex110407.log')
-        file_contents = file_object['Body'].read().decode().split('\n')
-        in_etl_1_flag = False
-    
-        split_logs = []
-        for line in file_contents:
-            split_logs.append(line.split(' '))
-
-        for log in split_logs:
-            if log[0].startswith('#'):
-                pass
-            else:
-                if len(log) == 18:
-                    print('-------- Executing INSERT Statement --------')
-                    cursor.execute(rf"""INSERT INTO public.s3_load(
-                                    date, time, server_ip, 
-                                    method, uri_stem, uri_query, 
-                                    server_port, username, client_ip, 
-                                    client_browser, client_cookie, 
-                                    client_referrer, status, 
-                                    substatus, win32_status, 
-                                    bytes_sent, bytes_received, 
-                                    duration, in_etl_1) VALUES (%s, %s, %s, %s, %s, 
-                                    %s, %s, %s, %s, %s, %s, %s, %s, %s, 
-                                    %s, %s, %s, %s, %s)""", (log[0],
-                                    log[1], log[2], log[3], log[4], log[5], 
-                                    log[6], log[7], log[8], log[9], log[10], 
-                                    log[11], log[12], log[13], log[14], log[15],
-                                    log[16], log[17], in_etl_1_flag))
-                    print('-------- Insert Statement Complete -------- ')
-                elif len(log) == 14:
-                    print('-------- Executing INSERT Statement --------')
-                    cursor.execute(rf"""INSERT INTO public.s3_load(
-                                    date, time, server_ip, 
-                                    method, uri_stem, uri_query, 
-                                    server_port, username, client_ip, 
-                                    client_browser, status, 
-                                    substatus, win32_status,  
-                                    duration, in_etl_1) VALUES (%s, %s, %s, %s, %s, 
-                                    %s, %s, %s, %s, %s, %s, %s, %s, %s, %s 
-                                    )""", (log[0], log[1], log[2], log[3], log[4], log[5], 
-                                    log[6], log[7], log[8], log[9], log[10], 
-                                    log[11], log[12], log[13], in_etl_1_flag))
-                    print('-------- Insert Statement Complete -------- ')
-                else:
-                    print('Unknown log length.')
+        # One row per S3 object whose rows have been committed to s3_load
+        SQL_CREATE = rf"""CREATE TABLE IF NOT EXISTS public.s3_load_manifest (
+                    key VARCHAR(1024), 
+                    etag VARCHAR(100), 
+                    row_count BIGINT, 
+                    loaded_at TIMESTAMP, 
+                    load_batch_id BIGINT,
+                    rejected_count BIGINT)"""
+        try:
+            print('-------- Executing CREATE TABLE --------')
+            cursor.execute(SQL_CREATE)
+            add_column(cursor, 'public.s3_load_manifest', 'load_batch_id', 'BIGINT')
+            add_column(cursor, 'public.s3_load_manifest', 'rejected_count', 'BIGINT')
+            print('-------- SQL CREATE Complete --------')
+        except Exception as err:
+            print('Error executing SQL: ', err)
 
-if __name__ == '__main__':
+def create_s3_client():
+    return boto3.client('s3',
+        aws_access_key_id=aws_access_key,
+        aws_secret_access_key=aws_secret_key)
+
+def list_log_keys(s3_client, bucket=log_bucket, prefix=log_prefix):
+    # list_objects only returns the first 1000 keys, so page through them
+    paginator = s3_client.get_paginator('list_objects_v2')
+    for page in paginator.paginate(Bucket=bucket, Prefix=prefix):
+        for obj in page.get('Contents', []):
+            if not obj['Key'].endswith('/'): # skip the 'BI_logs/' folder itself
+                yield obj['Key'], obj['ETag']
+
+def loaded_keys() -> set:
+    with UseRedshift(redshift_db_config) as cursor:
+        cursor.execute(rf"""SELECT key FROM public.s3_load_manifest""")
+        return {row[0] for row in cursor.fetchall()}
+
+CLIENT_BROWSER = LOG_COLUMNS.index('client_browser')
+
+def load_object(s3_client, key, etag=None) -> int:
+    # The rows, the manifest entry and the release of the batch id are
+    # committed in the same transaction, so a failed object is simply
+    # retried on the next run
+    with UseRedshift(redshift_db_config) as cursor:
+        load_batch_id = next_batch_id(cursor)
+    try:
+        return load_batch(s3_client, key, etag, load_batch_id)
+    except Exception:
+        # Rolled back: the batch is abandoned, not still loading. If even
+        # this fails the claim expires, and the load error is the one raised
+        try:
+            with UseRedshift(redshift_db_config) as cursor:
+                release_batch(cursor, load_batch_id)
+        except Exception as err:
+            print(f'Error releasing load batch {load_batch_id}: ', err)
+        raise
+
+@timed('s3_load')
+def load_batch(s3_client, key, etag, load_batch_id: int) -> int:
+    with UseRedshift(redshift_db_config) as cursor:
+        load_stage  = stage('s3_load')
+        typed       = False
+        counts      = {} # 'rejected': malformed lines, filled in once parsed
+        compression = compression_for(key)
+        if parse_workers > 1 and compression is None:
+            # Ranged GETs can only split uncompressed objects, so one without
+            # a suffix is sniffed first
+            file_object = s3_client.head_object(Bucket=log_bucket, Key=key)
+            if file_object['ContentLength'] > 0:
+                compression = detect_compression(s3_client.get_object(
+                    Bucket=log_bucket, Key=key,
+                    Range=f'bytes=0-{MAGIC_LENGTH - 1}')['Body'].read())
+        if parse_workers > 1 and compression is None:
+            # Ranged GETs parsed in a process pool; for parquet the records
+            # are cast there as well
+            load_stage.add(bytes=file_object['ContentLength'])
+            typed = load_mode == 'parquet'
+            logs  = load_stage.count_rows(chain.from_iterable(parse_source(
+                S3Source(create_s3_client, log_bucket, key), parse_workers, typed=typed,
+                counts=counts)))
+        else:
+            file_object = s3_client.get_object(Bucket=log_bucket, Key=key)
+            # Stream the object body so rows are loaded while it downloads;
+            # .gz / .bz2 objects are decompressed on the fly
+            logs = load_stage.count_rows(parse_logs(iter_lines(
+                load_stage.count_read(file_object['Body']), compression=compression),
+                counts))
+
+        if load_mode == 'parquet':
+            rows      = logs if typed else (to_etl_1_row(log) for log in logs)
+            if skip_crawlers:
+                rows = (row for row in rows if not is_crawler(row[CLIENT_BROWSER]))
+            row_count = export_and_load(cursor, rows,
+                                        load_batch_id, with_keys=key_mode == 'hash',
+                                        s3_client=s3_client, bucket=staging_bucket,
+                                        prefix=parquet_prefix, iam_role=redshift_iam_role,
+                                        directory=parquet_dir)
+        elif load_mode == 'copy':
+            row_count = copy_logs(cursor, logs, load_batch_id, s3_client)
+        else:
+            row_count = insert_logs(cursor, logs, load_batch_id)
+
+        rejected = counts.get('rejected', 0)
+        stage('s3_rejected', unit='lines').add(rows=rejected)
+        if rejected:
+            print(f'-------- Rejected {rejected} malformed lines in {key} --------')
+        cursor.execute(rf"""INSERT INTO public.s3_load_manifest(
+                            key, etag, row_count, loaded_at, load_batch_id, rejected_count)
+                            VALUES (%s, %s, %s, %s, %s, %s)""",
+                            (key, etag or file_object.get('ETag'), row_count,
+                             datetime.utcnow(), load_batch_id, rejected))
+        release_batch(cursor, load_batch_id)
+        return row_count
+
+def insert_into_table(key=log_key):
+    load_object(create_s3_client(), key)
+
+@timed('s3_objects', unit='objects')
+def insert_into_bucket(workers=ingest_workers, s3_client=None):
+    s3_client = s3_client or create_s3_client() # boto3 clients are thread safe
+    done      = loaded_keys()
+    pending   = [(key, etag) for key, etag in list_log_keys(s3_client)
+                 if key not in done]
+    print(f'-------- {len(pending)} new objects to load --------')
+    objects = stage('s3_objects', total=len(pending), unit='objects')
+
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        futures = {pool.submit(load_object, s3_client, key, etag): key
+                   for key, etag in pending}
+        for future in as_completed(futures):
+            try:
+                row_count = future.result()
+                objects.add(rows=1)
+                print(f'-------- Loaded {futures[future]} ({row_count} rows) --------')
+            except Exception as err:
+                print(f'Error loading {futures[future]}: ', err)
+
+def main():
     create_table()
-    insert_into_table()
+    create_manifest_table()
+    if load_mode == 'parquet':
+        from redshift_etl_1 import create_table as create_etl_1_table
+        create_etl_1_table()
+    if log_key:
+        insert_into_table()
+    else:
+        insert_into_bucket()
 
 
-        ######## Code to bulk load data from S3 to redshift ########
-        ######## COPY is more performant than individual INSERT INTO statements ########
-        ######## To be swapped/optimised at a later date ########
-        # rf"""COPY public.s3_load FROM 's3://la-ticket-bucket-eu/u_ex091024.log'
-        # IAM_ROLE 'arn:aws:iam::900056063831:role/RedshiftCopyUnload' DELIMITER '\n'"""
+if __name__ == '__main__':
+    main()
+    print('-------- Connection pool: ', pool_stats(redshift_db_config), ' --------')
+    write_summary(pool=pool_stats(redshift_db_config))
+    report_trace()
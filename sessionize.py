@@ -0,0 +1,219 @@
+#! /usr/bin/env python3
+
+######## Splits each client's (client_ip, client_browser) traffic into sessions ########
+######## New etl_1 rows are streamed in (client_ip, client_browser, time) order ########
+######## and assigned in one pass; sessions still open at the end of a run are ########
+######## carried over to the next one through public.open_sessions. ########
+
+import os
+from datetime import timedelta
+from redshift_connect import UseRedshift, pool_stats
+from bulk_load import insert_values
+from dimensions import dimension_key
+from pipeline_state import create_state_table, pending_batches, set_watermark
+from metrics import stage, timed, write_summary
+from sql_trace import report_trace
+from redshift_etl_2 import redshift_db_config
+
+# A request more than SESSION_GAP_MINUTES after the previous one from the
+# same client starts a new session
+SESSION_GAP        = timedelta(minutes=float(os.environ.get('SESSION_GAP_MINUTES', 30)))
+SESSION_BATCH_SIZE = int(os.environ.get('SESSION_BATCH_SIZE', 10000))
+
+SESSION_COLUMNS = ('id', 'client_ip', 'client_browser', 'started_at', 'ended_at',
+                   'hits', 'bytes_sent')
+OPEN_COLUMNS    = ('client_ip', 'client_browser', 'session_id', 'started_at', 'last_seen')
+
+def create_table():
+    with UseRedshift(redshift_db_config) as cursor:
+        SQL_CREATE_SESSION = rf"""CREATE TABLE IF NOT EXISTS public.dim_session (
+                    id VARCHAR(50),
+                    client_ip VARCHAR(20),
+                    client_browser VARCHAR(1000),
+                    started_at TIMESTAMP,
+                    ended_at TIMESTAMP,
+                    hits BIGINT,
+                    bytes_sent BIGINT)"""
+        SQL_CREATE_OPEN = rf"""CREATE TABLE IF NOT EXISTS public.open_sessions (
+                    client_ip VARCHAR(20),
+                    client_browser VARCHAR(1000),
+                    session_id VARCHAR(50),
+                    started_at TIMESTAMP,
+                    last_seen TIMESTAMP)"""
+        try:
+            print('-------- Executing CREATE TABLE --------')
+            cursor.execute(SQL_CREATE_SESSION)
+            cursor.execute(SQL_CREATE_OPEN)
+            create_state_table(cursor)
+            print('-------- SQL CREATE Complete --------')
+        except Exception as err:
+            print('Error executing SQL: ', err)
+
+class Session:
+
+    # hits and bytes_sent count this run's requests only; they are added to
+    # the dim_session row when it already exists
+
+    def __init__(self, session_id: str, started_at, last_seen=None) -> None:
+        self.id         = session_id
+        self.started_at = started_at
+        self.last_seen  = last_seen or started_at
+        self.hits       = 0
+        self.bytes_sent = 0
+
+    def add(self, time, bytes_sent) -> None:
+        self.last_seen   = max(self.last_seen, time)
+        self.hits       += 1
+        self.bytes_sent += bytes_sent or 0
+
+class Sessionizer:
+
+    # Takes rows in (client_ip, client_browser, time) order, so only the
+    # current client's session is being built at any time. `carried` holds
+    # the sessions left open by the last run; sessions that may still be
+    # extended by the next run end up in `still_open`, every session touched
+    # by this run in `finished` (drained by the caller)
+
+    def __init__(self, carried: dict, horizon, gap: timedelta = SESSION_GAP) -> None:
+        self.carried    = carried
+        self.horizon    = horizon # last_seen before this: the session is closed
+        self.gap        = gap
+        self.key        = None
+        self.current    = None
+        self.still_open = {}
+        self.finished   = []
+
+    def add(self, key: tuple, time, bytes_sent) -> str:
+        if key != self.key:
+            self.close_client()
+            self.key     = key
+            self.current = self.carried.pop(key, None)
+        if self.current is None or time - self.current.last_seen > self.gap:
+            self.end_session()
+            self.current = Session(dimension_key(*key, time), time)
+        self.current.add(time, bytes_sent)
+        return self.current.id
+
+    def end_session(self) -> None:
+        if self.current is not None and self.current.hits:
+            self.finished.append((self.key, self.current))
+        self.current = None
+
+    def close_client(self) -> None:
+        # The client's last session stays open if a request in the next run
+        # could still fall within the gap
+        if self.current is not None and self.current.last_seen >= self.horizon:
+            self.still_open[self.key] = self.current
+        self.end_session()
+
+    def open_sessions(self) -> dict:
+        # Call once every row has been added
+        self.close_client()
+        self.key = None
+        return {**{key: session for key, session in self.carried.items()
+                   if session.last_seen >= self.horizon},
+                **self.still_open}
+
+def load_open_sessions(cursor) -> dict:
+    cursor.execute(rf"""SELECT {', '.join(OPEN_COLUMNS)} FROM public.open_sessions""")
+    return {(client_ip, client_browser): Session(session_id, started_at, last_seen)
+            for client_ip, client_browser, session_id, started_at, last_seen
+            in cursor.fetchall()}
+
+def session_rows(sessions) -> list:
+    return [(session.id, *key, session.started_at, session.last_seen,
+             session.hits, session.bytes_sent) for key, session in sessions]
+
+SELECT_ETL_1 = rf"""SELECT id, client_ip, client_browser, time, bytes_sent
+                    FROM public.etl_1
+                    WHERE load_batch_id > %s AND load_batch_id <= %s
+                        AND time IS NOT NULL
+                    ORDER BY client_ip, client_browser, time"""
+
+def assign_sessions(cursor, batches, gap: timedelta = SESSION_GAP,
+                    batch_size: int = SESSION_BATCH_SIZE) -> None:
+    # Visit ids and session deltas are staged in temp tables batch by batch
+    # and applied with one UPDATE / INSERT each at the end
+    cursor.execute(rf"""SELECT MAX(time) FROM public.etl_1
+                        WHERE load_batch_id > %s AND load_batch_id <= %s""", batches)
+    latest = cursor.fetchone()[0]
+    if latest is None:
+        return
+    sessionizer   = Sessionizer(load_open_sessions(cursor), latest - gap, gap)
+    session_stage = stage('sessions')
+    cursor.execute(rf"""CREATE TEMP TABLE stage_session_ids (
+                        id VARCHAR(50), session_id VARCHAR(50))""")
+    cursor.execute(rf"""CREATE TEMP TABLE stage_dim_session (LIKE public.dim_session)""")
+    source = cursor.connection.cursor(name='etl_1_to_sessions')
+    source.itersize = batch_size
+    source.execute(SELECT_ETL_1, batches)
+    while True:
+        rows = source.fetchmany(batch_size)
+        if not rows:
+            break
+        session_ids = [(row_id, sessionizer.add((client_ip, client_browser), time, bytes_sent))
+                       for row_id, client_ip, client_browser, time, bytes_sent in rows]
+        insert_values(cursor, 'stage_session_ids', ('id', 'session_id'), session_ids,
+                      page_size=batch_size)
+        insert_values(cursor, 'stage_dim_session', SESSION_COLUMNS,
+                      session_rows(sessionizer.finished), page_size=batch_size)
+        session_stage.add(rows=len(rows))
+        sessionizer.finished = []
+    source.close()
+    open_sessions = sessionizer.open_sessions()
+    insert_values(cursor, 'stage_dim_session', SESSION_COLUMNS,
+                  session_rows(sessionizer.finished), page_size=batch_size)
+
+    cursor.execute(rf"""UPDATE public.etl_1
+                        SET session_id = stage_session_ids.session_id
+                        FROM stage_session_ids
+                        WHERE public.etl_1.id = stage_session_ids.id""")
+    cursor.execute(rf"""UPDATE public.dim_session
+                        SET ended_at = GREATEST(public.dim_session.ended_at,
+                                                stage_dim_session.ended_at),
+                            hits = public.dim_session.hits + stage_dim_session.hits,
+                            bytes_sent = public.dim_session.bytes_sent
+                                         + stage_dim_session.bytes_sent
+                        FROM stage_dim_session
+                        WHERE public.dim_session.id = stage_dim_session.id""")
+    extended = cursor.rowcount
+    cursor.execute(rf"""INSERT INTO public.dim_session ({', '.join(SESSION_COLUMNS)})
+                        SELECT {', '.join(f'stage.{column}' for column in SESSION_COLUMNS)}
+                        FROM stage_dim_session stage
+                        WHERE NOT EXISTS (SELECT 1 FROM public.dim_session existing
+                                          WHERE existing.id = stage.id)""")
+    print(f'-------- Inserted {cursor.rowcount} SESSION rows, '
+          f'extended {extended}, {len(open_sessions)} left open --------')
+
+    cursor.execute(rf"""DELETE FROM public.open_sessions""")
+    insert_values(cursor, 'public.open_sessions', OPEN_COLUMNS,
+                  [(*key, session.id, session.started_at, session.last_seen)
+                   for key, session in open_sessions.items()], page_size=batch_size)
+    # Only on success: after an error the rollback removes the temp tables
+    cursor.execute(rf"""DROP TABLE stage_session_ids""")
+    cursor.execute(rf"""DROP TABLE stage_dim_session""")
+
+@timed('sessions')
+def sessionize_new_batches(gap: timedelta = SESSION_GAP):
+    # One transaction: ids, sessions, open sessions and the watermark all
+    # move together, so a failed run is simply repeated
+    with UseRedshift(redshift_db_config) as cursor:
+        # Serialises concurrent runs before the watermark is read
+        cursor.execute(rf"""LOCK public.open_sessions""")
+        batches = pending_batches(cursor, 'sessions', 'public.etl_1')
+        if batches is None:
+            print('-------- No new load batches --------')
+            return
+        assign_sessions(cursor, batches, gap)
+        set_watermark(cursor, 'sessions', batches[1])
+
+def main():
+    create_table()
+    sessionize_new_batches()
+
+
+if __name__ == '__main__':
+    main()
+    print('-------- Connection pool: ', pool_stats(redshift_db_config), ' --------')
+    write_summary(pool=pool_stats(redshift_db_config))
+    report_trace()
@@ -0,0 +1,126 @@
+#! /usr/bin/env python3
+
+import os
+import re
+import json
+import time
+import threading
+from psycopg2.extensions import cursor as _cursor
+
+# SQL_TRACE=1 makes UseRedshift hand out TracingCursors; SQL_EXPLAIN=1 also
+# captures the EXPLAIN plan of each distinct statement (once, before its
+# first run). Statements slower than SQL_SLOW_MS are counted as slow
+SQL_TRACE        = os.environ.get('SQL_TRACE', '0') not in ('', '0')
+SQL_EXPLAIN      = os.environ.get('SQL_EXPLAIN', '0') not in ('', '0')
+SQL_SLOW_MS      = float(os.environ.get('SQL_SLOW_MS', 1000))
+SQL_TRACE_REPORT = os.environ.get('SQL_TRACE_REPORT', 'sql_trace.json')
+
+_EXPLAINABLE = re.compile(r'^\s*(SELECT|INSERT|UPDATE|DELETE|WITH)\b', re.IGNORECASE)
+_VALUES      = r'\(\s*\?(?:\s*,\s*\?)*\s*\)'
+_NORMALIZE   = ((re.compile(r"(?:\bE)?'(?:[^']|'')*'"), '?'),              # string literals
+                (re.compile(r'%(?:\(\w+\))?s'), '?'),                      # placeholders
+                (re.compile(r'\b\d+(?:\.\d+)?(?:[eE][+-]?\d+)?\b'), '?'),   # numbers
+                (re.compile(r'\?::\w+(?:\[\])?'), '?'),                     # '...'::date etc.
+                # as psycopg2 writes list members: ' -5', NULL, true / false
+                (re.compile(r'(?<=[(,])\s*(?:-\s*\?|NULL|TRUE|FALSE)\s*(?=[,)])',
+                            re.IGNORECASE), '?'),
+                (re.compile(rf'{_VALUES}(?:\s*,\s*{_VALUES})*'), '(...)'), # VALUES / IN lists
+                (re.compile(r'\s+'), ' '))
+
+def normalize(query) -> str:
+    # Statements that differ only in literals or list lengths share a key,
+    # e.g. every execute_values page of the same INSERT, whatever its
+    # length or mix of NULLs
+    if isinstance(query, bytes):
+        query = query.decode('utf-8', 'replace')
+    for pattern, replacement in _NORMALIZE:
+        query = pattern.sub(replacement, query)
+    return query.strip()
+
+class SqlTracer:
+
+    def __init__(self, slow_ms: float = SQL_SLOW_MS, explain: bool = SQL_EXPLAIN) -> None:
+        self.slow_seconds = slow_ms / 1000
+        self.explain      = explain
+        self.statements   = {}
+        self.lock         = threading.Lock()
+
+    def wants_plan(self, key: str) -> bool:
+        with self.lock:
+            return self.explain and (key not in self.statements
+                                     or self.statements[key]['plan'] is None)
+
+    def record(self, key: str, seconds: float, rowcount: int, plan: list = None) -> None:
+        with self.lock:
+            entry = self.statements.setdefault(key, {'query': key, 'calls': 0, 'seconds': 0.0,
+                                                     'max_seconds': 0.0, 'rows': 0,
+                                                     'slow_calls': 0, 'plan': None})
+            entry['calls']      += 1
+            entry['seconds']    += seconds
+            entry['max_seconds'] = max(entry['max_seconds'], seconds)
+            entry['rows']       += max(rowcount, 0)
+            entry['slow_calls'] += seconds >= self.slow_seconds
+            if plan is not None:
+                entry['plan'] = plan
+
+    def report(self, limit: int = 20) -> list:
+        # Statements by total time spent, slowest first
+        with self.lock:
+            entries = sorted((dict(entry) for entry in self.statements.values()),
+                             key=lambda entry: entry['seconds'], reverse=True)
+        return entries[:limit]
+
+    def format_report(self, limit: int = 20) -> str:
+        lines = [f'{"seconds":>10} {"calls":>7} {"slow":>5} {"rows":>12}  statement']
+        for entry in self.report(limit):
+            lines.append(f'{entry["seconds"]:>10.2f} {entry["calls"]:>7} '
+                         f'{entry["slow_calls"]:>5} {entry["rows"]:>12}  {entry["query"][:120]}')
+        return '\n'.join(lines)
+
+    def write_report(self, path: str = SQL_TRACE_REPORT, limit: int = None) -> None:
+        with open(path, 'w') as report_file:
+            json.dump(self.report(limit), report_file, indent=2)
+
+    def reset(self) -> None:
+        with self.lock:
+            self.statements = {}
+
+# Shared by every TracingCursor in the process
+tracer = SqlTracer()
+
+class TracingCursor(_cursor):
+
+    # Times every statement (including the ones execute_values and COPY send)
+    # and records it in `tracer` under its normalized text
+
+    def execute(self, query, vars=None):
+        key  = normalize(query)
+        plan = None
+        if tracer.wants_plan(key) and _EXPLAINABLE.match(key):
+            plan = self.explain(query, vars)
+        start = time.perf_counter()
+        try:
+            return super().execute(query, vars)
+        finally:
+            tracer.record(key, time.perf_counter() - start, self.rowcount, plan)
+
+    def copy_expert(self, sql, file, size=8192):
+        start = time.perf_counter()
+        try:
+            return super().copy_expert(sql, file, size)
+        finally:
+            tracer.record(normalize(sql), time.perf_counter() - start, self.rowcount)
+
+    def explain(self, query, vars=None) -> list:
+        # Plan only: the statement itself is not run
+        prefix = b'EXPLAIN ' if isinstance(query, bytes) else 'EXPLAIN '
+        super().execute(prefix + query, vars)
+        return [row[0] for row in self.fetchall()]
+
+def report_trace(path: str = SQL_TRACE_REPORT, limit: int = 20) -> None:
+    if not tracer.statements:
+        return
+    print('-------- Slowest statements --------')
+    print(tracer.format_report(limit))
+    tracer.write_report(path)
+    print(f'-------- SQL trace written to {path} --------')
@@ -0,0 +1,20 @@
+import os
+import pytest
+import psycopg2
+from sql_trace import TracingCursor
+
+@pytest.fixture
+def cursor():
+    # A scratch database in the usual REDSHIFT_* / DB_NAME variables
+    try:
+        conn = psycopg2.connect(dbname=os.environ['DB_NAME'],
+                                host=os.environ['REDSHIFT_ENDPT'],
+                                port=os.environ['REDSHIFT_PORT'],
+                                user=os.environ['REDSHIFT_USER'],
+                                password=os.environ.get('REDSHIFT_PW'),
+                                connect_timeout=3, cursor_factory=TracingCursor)
+    except (KeyError, psycopg2.OperationalError):
+        pytest.skip('no database configured')
+    yield conn.cursor()
+    conn.rollback()
+    conn.close()
@@ -0,0 +1,17 @@
+from bulk_load import upsert_rows
+
+# Run in the fixture's transaction, which is rolled back afterwards
+
+def test_upsert_matches_null_keys(cursor):
+    cursor.execute("""CREATE TABLE public.upsert_check (
+                      id VARCHAR(10), uri_stem VARCHAR(80), bytes_sent INTEGER)""")
+    columns, keys = ('id', 'uri_stem', 'bytes_sent'), ('uri_stem', 'bytes_sent')
+    rows = [('a', '/', 10), ('b', '/', None), ('c', None, None), ('d', '', 0), ('e', None, 0)]
+    assert upsert_rows(cursor, 'public.upsert_check', columns, keys, rows,
+                       sentinels={'bytes_sent': '0'}) == 5
+    # NULL matches NULL only, not the '' / 0 stand-ins
+    again = [('f', '/', None), ('g', None, None), ('h', '', None), ('i', '', 0), ('j', None, 10)]
+    assert upsert_rows(cursor, 'public.upsert_check', columns, keys, again,
+                       sentinels={'bytes_sent': '0'}) == 2
+    cursor.execute("""SELECT id FROM public.upsert_check ORDER BY id""")
+    assert [row[0] for row in cursor.fetchall()] == ['a', 'b', 'c', 'd', 'e', 'h', 'j']
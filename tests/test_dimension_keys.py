@@ -0,0 +1,37 @@
+import datetime
+import pytest
+from psycopg2.extras import execute_values
+from log_generator import generate_lines
+from log_parser import LogParser, LOG_COLUMNS, INT_COLUMNS
+from dimensions import FACT_KEY_COLUMNS, dimension_key_sql, fact_keys
+
+# KEY_MODE=hash only works if Python and SQL hash every key the same way
+
+TYPES = {'date': 'DATE', 'time': 'TIMESTAMP', **{column: 'INTEGER' for column in INT_COLUMNS}}
+
+def typed_rows() -> list:
+    rows = [row for layout in (18, 14)
+            for row in LogParser(typed=True).parse(generate_lines(200, layout=layout, seed=5))]
+    edge = dict(zip(LOG_COLUMNS, rows[0]))
+    blank = {**{column: '' for column in LOG_COLUMNS if column not in TYPES},
+             'date': datetime.date(2011, 1, 1), 'time': datetime.datetime(2011, 1, 1, 23, 59, 59, 999999)}
+    nulls = {column: None for column in LOG_COLUMNS}
+    zeros = {**edge, **{column: 0 for column in INT_COLUMNS}}
+    bucket_edges = [{**edge, 'duration': duration} for duration in (99, 100, 29999, 30000)]
+    rows += [tuple(row.get(column) for column in LOG_COLUMNS)
+             for row in (blank, nulls, zeros, *bucket_edges)]
+    return rows
+
+def test_sql_keys_match_python_keys(cursor):
+    cursor.execute(f"""CREATE TEMP TABLE key_check (
+                       row_number INTEGER,
+                       {', '.join(f'{column} {TYPES.get(column, "VARCHAR(1000)")}'
+                                  for column in LOG_COLUMNS)})""")
+    rows = typed_rows()
+    execute_values(cursor, f"""INSERT INTO key_check (row_number, {', '.join(LOG_COLUMNS)})
+                               VALUES %s""", [(i, *row) for i, row in enumerate(rows)])
+    cursor.execute(f"""SELECT {', '.join(dimension_key_sql(dimension, 'key_check')
+                                         for dimension in FACT_KEY_COLUMNS)}
+                       FROM key_check ORDER BY row_number""")
+    for row, sql_keys in zip(rows, cursor.fetchall()):
+        assert dict(zip(FACT_KEY_COLUMNS, sql_keys)) == dict(zip(FACT_KEY_COLUMNS, fact_keys(row))), row
@@ -0,0 +1,58 @@
+import ipaddress
+import pytest
+from geo_index import GeoIndex
+
+DE = ('10115', 'Berlin', 'Berlin', 'DE')
+FR = ('75001', 'Paris', 'Ile-de-France', 'FR')
+GB = ('EC1A', 'London', 'England', 'GB')
+
+def network(cidr: str, location: tuple) -> tuple:
+    network = ipaddress.ip_network(cidr)
+    return network[0], network[-1], location
+
+def country(index: GeoIndex, ip: str):
+    location = index.lookup(ip)
+    return location and location['country']
+
+@pytest.fixture(params=('built', 'loaded'))
+def index(request, tmp_path):
+    index = GeoIndex.from_ranges([network('10.0.0.0/8', DE),
+                                  network('10.1.0.0/24', FR),
+                                  network('10.1.0.128/25', GB),
+                                  network('10.200.0.0/16', DE),
+                                  network('2001:db8::/32', DE),
+                                  network('2001:db8:1::/48', FR)])
+    if request.param == 'built':
+        return index
+    index.save(str(tmp_path / 'geo.idx'))
+    return GeoIndex.load(str(tmp_path / 'geo.idx'))
+
+def test_most_specific_range_wins(index):
+    assert country(index, '10.2.0.1') == 'DE'
+    assert country(index, '10.0.255.255') == 'DE'
+    assert country(index, '10.1.0.1') == 'FR'
+    assert country(index, '10.1.0.127') == 'FR'
+    assert country(index, '10.1.0.128') == 'GB'
+    assert country(index, '10.1.0.255') == 'GB'
+    assert country(index, '10.1.1.0') == 'DE'
+    assert country(index, '10.200.3.4') == 'DE'
+    assert country(index, '10.255.255.255') == 'DE'
+    assert country(index, '11.0.0.0') is None
+    assert country(index, '9.255.255.255') is None
+    assert country(index, '2001:db8:2::1') == 'DE'
+    assert country(index, '2001:db8:1::1') == 'FR'
+    assert country(index, '2001:db9::1') is None
+
+def test_flattened_intervals_are_disjoint(index):
+    starts, ends, _ = index.v4
+    assert all(ends[i] < starts[i + 1] for i in range(len(starts) - 1))
+    # 10/8 around 10.1.0.0/24 (FR, then GB): 4 pieces, the /16 merged into its parent
+    assert len(starts) == 4
+
+def test_later_row_wins_for_the_same_range():
+    index = GeoIndex.from_ranges([network('10.0.0.0/8', DE), network('10.0.0.0/8', FR)])
+    assert country(index, '10.1.2.3') == 'FR'
+
+def test_invalid_range_is_rejected():
+    with pytest.raises(ValueError):
+        GeoIndex.from_ranges([('10.0.0.9', '10.0.0.1', DE)])
@@ -0,0 +1,57 @@
+import geo_lookup
+from dim_cache import DimensionCache
+
+def test_geo_index_opened_once(monkeypatch):
+    opened = []
+    class Index:
+        def lookup_many(self, client_ips):
+            return {ip: {'country': 'DE'} for ip in client_ips}
+    def open_index(index_path, csv_path):
+        opened.append(index_path)
+        return Index()
+    monkeypatch.setattr(geo_lookup, 'open_index', open_index)
+    monkeypatch.setattr(geo_lookup, '_resolvers', {})
+    for ip in ('10.0.0.1', '10.0.0.2', '10.0.0.3'):
+        resolve = geo_lookup.shared_resolver('geo.idx', None, workers=8, rate=10.0)
+        assert resolve([ip]) == {ip: {'country': 'DE'}}
+    assert len(opened) == 1
+
+def test_geo_cache_opened_once(monkeypatch, tmp_path):
+    monkeypatch.setattr(geo_lookup, '_resolvers', {})
+    monkeypatch.setattr(geo_lookup, '_caches', [])
+    cache_path = str(tmp_path / 'geo_cache.sqlite')
+    resolvers  = [geo_lookup.shared_resolver(None, None, cache_path, workers=8, rate=10.0)
+                  for _ in range(3)]
+    assert resolvers[0] is resolvers[1] is resolvers[2]
+    assert len(geo_lookup._caches) == 1
+    geo_lookup.close_caches()
+
+def test_failed_lookups_get_no_member():
+    located = {'10.0.0.1': {'country': 'DE'}}
+    asked   = []
+    def locate(client_ips):
+        asked.append(sorted(client_ips))
+        return {ip: located[ip] for ip in client_ips if ip in located}
+    cache = DimensionCache('location', lambda ip: f'id-{ip}', locate=locate)
+    keys  = [('10.0.0.1',), ('10.0.0.2',), (None,), ('10.0.0.2',)]
+    assert cache.resolve_many(None, keys) == ['id-10.0.0.1', None, 'id-None', None]
+    assert {key: (dim_id, location) for dim_id, key, location in cache.pending} == \
+        {('10.0.0.1',): ('id-10.0.0.1', {'country': 'DE'}), (None,): ('id-None', None)}
+    # Not remembered, so the next batch looks it up again
+    located['10.0.0.2'] = {'country': 'FR'}
+    assert cache.resolve_many(None, [('10.0.0.2',), ('10.0.0.1',)]) == ['id-10.0.0.2', 'id-10.0.0.1']
+    assert asked == [['10.0.0.1', '10.0.0.2'], ['10.0.0.2']]
+
+def test_expired_locations_evicted_on_open(monkeypatch, tmp_path):
+    monkeypatch.setattr(geo_lookup, '_resolvers', {})
+    monkeypatch.setattr(geo_lookup, '_caches', [])
+    cache_path = str(tmp_path / 'geo_cache.sqlite')
+    cache      = geo_lookup.GeoCache(cache_path)
+    cache.put_many({'10.0.0.1': {'country': 'DE'}, '10.0.0.2': {'country': 'FR'}})
+    cache.conn.execute("UPDATE geo_cache SET fetched_at = 0 WHERE ip = '10.0.0.1'")
+    cache.conn.commit()
+    cache.close()
+    geo_lookup.shared_resolver(None, None, cache_path)
+    rows = geo_lookup._caches[0].conn.execute('SELECT ip FROM geo_cache').fetchall()
+    assert rows == [('10.0.0.2',)]
+    geo_lookup.close_caches()
@@ -0,0 +1,20 @@
+import io
+import bz2
+import gzip
+import pytest
+from log_stream import iter_lines
+
+LINES = [f'2011-04-07 00:00:{i % 60:02} 10.0.0.{i % 256} GET /page/{i}' for i in range(20000)]
+DATA  = '\n'.join(LINES).encode()
+
+@pytest.mark.parametrize('compress', (gzip.compress, bz2.compress))
+def test_concatenated_streams_read_whole(compress):
+    body = io.BytesIO(compress(DATA + b'\n') + compress(DATA))
+    assert list(iter_lines(body, chunk_size=4096)) == LINES + LINES
+
+@pytest.mark.parametrize('compress', (gzip.compress, bz2.compress))
+def test_truncated_object_raises(compress):
+    data = compress(DATA)
+    with pytest.raises(EOFError):
+        for _ in iter_lines(io.BytesIO(data[:len(data) // 2]), chunk_size=4096):
+            pass
@@ -0,0 +1,14 @@
+from log_generator import generate_log
+from parallel_parse import LocalSource, parse_source
+
+def test_rejected_lines_counted_across_ranges(tmp_path):
+    lines = generate_log(3000, 18, seed=2).split(b'\n')
+    for i in range(50, 3000, 300):
+        lines[i] = b'not a log line'
+    path = tmp_path / 'rejected.log'
+    path.write_bytes(b'\n'.join(lines))
+    counts  = {}
+    records = sum(len(batch) for batch in parse_source(LocalSource(str(path)), workers=2,
+                                                       range_bytes=16384, counts=counts))
+    assert counts == {'rejected': 10}
+    assert records == 2990
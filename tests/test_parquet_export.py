@@ -0,0 +1,33 @@
+import pytest
+from log_generator import generate_lines
+from log_parser import LogParser
+from parquet_export import etl_1_columns, etl_1_records, local_writer, write_partitions
+
+pyarrow = pytest.importorskip('pyarrow')
+import pyarrow.parquet
+
+@pytest.mark.parametrize('layout', (18, 14))
+@pytest.mark.parametrize('with_keys', (False, True))
+def test_files_read_back_as_etl_1_rows(tmp_path, layout, with_keys):
+    rows    = list(LogParser(typed=True).parse(generate_lines(500, layout=layout, seed=3)))
+    columns = etl_1_columns(with_keys)
+    records = list(etl_1_records(rows, 7, with_keys))
+    written = write_partitions(iter(records), columns, local_writer(str(tmp_path)),
+                               'parquet/', 7, rows_per_file=200)
+
+    read_back = []
+    for path in written:
+        table = pyarrow.parquet.read_table(path)
+        assert table.schema.names == list(columns)
+        assert str(table.schema.field('date').type) == 'date32[day]'
+        assert str(table.schema.field('time').type) == 'timestamp[us]'
+        assert str(table.schema.field('status').type) == 'int32'
+        assert str(table.schema.field('load_batch_id').type) == 'int64'
+        file_rows = [tuple(row[column] for column in columns) for row in table.to_pylist()]
+        # One date per file, named after its partition
+        assert {row[columns.index('date')].isoformat() for row in file_rows} == \
+            {path.split('date=')[1].split('/')[0]}
+        read_back += file_rows
+
+    assert len(written) >= 3
+    assert sorted(read_back, key=lambda row: row[0]) == sorted(records, key=lambda row: row[0])
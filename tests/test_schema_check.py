@@ -0,0 +1,23 @@
+import pytest
+from pipeline_state import check_columns, REPLACED_COLUMNS
+
+# Run in the fixture's transaction, which is rolled back afterwards
+
+def create_current_tables(cursor) -> None:
+    cursor.execute("""DROP TABLE IF EXISTS public.dim_time""")
+    cursor.execute("""DROP TABLE IF EXISTS public.dim_request""")
+    cursor.execute("""CREATE TABLE public.dim_time (id VARCHAR(50), second_of_day INTEGER)""")
+    cursor.execute("""CREATE TABLE public.dim_request (id VARCHAR(50), duration_bucket VARCHAR(20))""")
+
+def test_current_tables_pass(cursor):
+    create_current_tables(cursor)
+    check_columns(cursor)
+
+@pytest.mark.parametrize('table, old_columns', (('public.dim_time', 'id VARCHAR(50), time TIMESTAMP'),
+                                                ('public.dim_request', 'id VARCHAR(50), duration INTEGER')))
+def test_old_tables_are_refused(cursor, table, old_columns):
+    create_current_tables(cursor)
+    cursor.execute(f"""DROP TABLE {table}""")
+    cursor.execute(f"""CREATE TABLE {table} ({old_columns})""")
+    with pytest.raises(RuntimeError, match=REPLACED_COLUMNS[table][0]):
+        check_columns(cursor)
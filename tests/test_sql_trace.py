@@ -0,0 +1,35 @@
+import datetime
+from psycopg2.extras import execute_values
+from sql_trace import normalize, tracer
+
+# execute_values pages as psycopg2 writes them: casts on dates and
+# timestamps, bare NULL / true / false, a space before negative numbers
+PAGES = ["INSERT INTO public.etl_1 (id, date, time, status, in_etl_2) VALUES "
+         "('a', '2011-04-07'::date, '2011-04-07T01:02:03'::timestamp, 200, true),"
+         "('b', NULL, NULL, -1, false)",
+         "INSERT INTO public.etl_1 (id, date, time, status, in_etl_2) VALUES "
+         "('c', '2011-04-08'::date, NULL, 304, NULL)",
+         "INSERT INTO public.etl_1 (id, date, time, status, in_etl_2) VALUES "
+         "(E'd\\\\e', NULL, '2011-04-08T00:00:00'::timestamp, 1e+20, true)"]
+
+def test_execute_values_pages_share_one_key():
+    keys = {normalize(page) for page in PAGES}
+    assert keys == {'INSERT INTO public.etl_1 (id, date, time, status, in_etl_2) VALUES (...)'}
+
+def test_conditions_stay_readable():
+    assert normalize("UPDATE t SET a = 1 WHERE b IS NULL AND c = 'x''y' AND d IN (1, 2)") == \
+        'UPDATE t SET a = ? WHERE b IS NULL AND c = ? AND d IN (...)'
+
+def test_real_execute_values_pages_share_one_key(cursor):
+    cursor.execute("""CREATE TEMP TABLE trace_check (a VARCHAR(10), d DATE, ts TIMESTAMP,
+                                                     n INT, b BOOLEAN, f FLOAT)""")
+    tracer.reset()
+    rows = [('a', datetime.date(2011, 4, 7), datetime.datetime(2011, 4, 7, 1, 2, 3), 5, True, 1.5),
+            (None, None, None, None, False, -2.0),
+            ('x', datetime.date(2011, 4, 8), None, -3, None, 1e20)]
+    for page_size in (1, 2, 3):
+        execute_values(cursor, 'INSERT INTO trace_check (a, d, ts, n, b, f) VALUES %s', rows,
+                       page_size=page_size)
+    inserts = [entry for entry in tracer.report() if entry['query'].startswith('INSERT')]
+    assert [(entry['query'], entry['calls']) for entry in inserts] == \
+        [('INSERT INTO trace_check (a, d, ts, n, b, f) VALUES (...)', 6)]
@@ -0,0 +1,66 @@
+#! /usr/bin/env python3
+
+import re
+from functools import lru_cache
+
+UA_CACHE_SIZE = 100000 # distinct user-agent strings remembered
+
+# First match wins, so more specific families come first. IIS logs write
+# spaces in cs(User-Agent) as '+', hence [+ ] in the patterns
+BROWSERS = (('Edge',    re.compile(r'Edge?/')),
+            ('Opera',   re.compile(r'OPR/|Opera')),
+            ('Chrome',  re.compile(r'Chrome/|CriOS/')),
+            ('Firefox', re.compile(r'Firefox/|FxiOS/')),
+            ('Safari',  re.compile(r'Version/[\d.]+.*Safari/')),
+            ('IE',      re.compile(r'MSIE[+ ]|Trident/')))
+SYSTEMS  = (('Windows Phone', re.compile(r'Windows[+ ]Phone')),
+            ('Windows',       re.compile(r'Windows')),
+            ('iOS',           re.compile(r'iPhone|iPad|iPod')),
+            ('Android',       re.compile(r'Android')),
+            ('Mac OS X',      re.compile(r'Mac[+ ]OS[+ ]X|Macintosh')),
+            ('Linux',         re.compile(r'Linux|X11')))
+DEVICES  = (('Tablet',  re.compile(r'iPad|Tablet|Android(?!.*Mobile)')),
+            ('Mobile',  re.compile(r'Mobile|iPhone|iPod|Windows[+ ]Phone|Android')))
+
+def _first_match(patterns, user_agent: str, default: str) -> str:
+    for name, pattern in patterns:
+        if pattern.search(user_agent):
+            return name
+    return default
+
+@lru_cache(maxsize=UA_CACHE_SIZE)
+def parse_user_agent(user_agent: str) -> tuple:
+    # browser, os, device_type; a few thousand distinct strings repeat
+    # millions of times, so each one is only matched once
+    if not user_agent or user_agent == '-':
+        return None, None, None
+    return (_first_match(BROWSERS, user_agent, 'Other'),
+            _first_match(SYSTEMS, user_agent, 'Other'),
+            _first_match(DEVICES, user_agent, 'Desktop'))
+
+# Known crawlers and HTTP libraries, matched case-insensitively anywhere in
+# the string. Lower case, plain text only (no regex metacharacters, no
+# quotes), so the combined pattern means the same to Python and to SQL's ~*.
+# Lower-casing the string once is ~10x faster than re.IGNORECASE here
+CRAWLER_PATTERNS = ('bot', 'crawl', 'spider', 'slurp', 'archiver', 'facebookexternalhit',
+                    'mediapartners', 'feedfetcher', 'yandex', 'baidu', 'ahrefs',
+                    'semrush', 'mj12', 'curl/', 'wget/', 'python-requests',
+                    'python-urllib', 'libwww-perl', 'java/', 'go-http-client',
+                    'httpclient', 'okhttp', 'headlesschrome', 'phantomjs',
+                    'pingdom', 'uptimerobot', 'monitor')
+CRAWLER_REGEX    = '|'.join(CRAWLER_PATTERNS)
+_CRAWLER         = re.compile(CRAWLER_REGEX)
+
+@lru_cache(maxsize=UA_CACHE_SIZE)
+def is_crawler(user_agent: str) -> bool:
+    return bool(user_agent) and _CRAWLER.search(user_agent.lower()) is not None
+
+def classify_many(user_agents) -> list:
+    # Each distinct string in the batch is classified once
+    user_agents = list(user_agents)
+    crawlers    = {user_agent: is_crawler(user_agent) for user_agent in set(user_agents)}
+    return [crawlers[user_agent] for user_agent in user_agents]
+
+def crawler_sql(column: str) -> str:
+    # SQL test of the same pattern list (Redshift and Postgres both have ~*)
+    return f"COALESCE({column}, '') ~* '{CRAWLER_REGEX}'"